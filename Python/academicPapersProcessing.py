@@ -8,26 +8,124 @@
 # - Filters papers based on the specified year and excludes certain document types (e.g., patents).
 # - Uses regular expressions and unicode normalization to clean and prepare text data for further analysis or storage.
 # - Employs multiprocessing to process files concurrently, significantly speeding up the data processing pipeline.
+# - Reads plain, gzip or zstd raw dumps (.txt, .txt.gz, .txt.zst), split into newline-aligned shards.
+# - Records progress in data/subset/manifest.json with per shard checkpoints, so an interrupted run resumes where it stopped.
+# - Writes per raw file {idx}.jsonl (.jsonl.zst with --compress-output, .arrow or .parquet with --output-format),
+#   {idx}.titles.jsonl and {idx}.errors.jsonl to data/subset.
+# - Builds the id -> title index as data/id2title.sqlite; data/id2title.json is only written with --id2title-json.
 
 # Highlights: fasttext, RegEx, pandas, multiprocessing, JSON parsing, command-line arguments
 
 import os
 import re
 import json
+import io
+import gzip
+import math
+import random
+import tempfile
+import shutil
+import hashlib
+import sqlite3
+import resource
 import argparse
+from time import perf_counter
 import fasttext
 from tqdm import tqdm
 import unicodedata as ud
+from typing import Any
+from contextlib import closing
+from itertools import chain
+from collections import namedtuple
 from multiprocessing import Pool
 
+# Optional faster JSON backends
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Optional compression backends
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+# Optional columnar output
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+#---------------
+
+# JSON backend: decode a raw line, decode it only if it passes the year/doc_type filter, encode an output line
+Codec = namedtuple('Codec', ['name', 'decode', 'decodeFiltered', 'encode'])
+
+CODECS = ['auto', 'msgspec', 'orjson', 'json']
+
+def keepPaper(year, docType, args):
+    return year <= args.year and docType != args.exclude_doc
+
+if msgspec is not None:
+
+    # Only the fields the filter needs, everything else is skipped by the decoder
+    class FilterFields(msgspec.Struct):
+        year: Any = msgspec.UNSET
+        doc_type: Any = None
+
+def getCodec(name):
+
+    # Use the fastest installed backend, the stdlib is always available
+    if name == 'auto':
+        name = 'msgspec' if msgspec is not None else 'orjson' if orjson is not None else 'json'
+
+    if name == 'msgspec':
+        decoder = msgspec.json.Decoder()
+        filterDecoder = msgspec.json.Decoder(FilterFields)
+        encoder = msgspec.json.Encoder()
+
+        def decodeFiltered(line, args):
+            fields = filterDecoder.decode(line)
+            year = args.year + 1 if fields.year is msgspec.UNSET else fields.year
+            return decoder.decode(line) if keepPaper(year, fields.doc_type, args) else None
+
+        return Codec(name, decoder.decode, decodeFiltered, lambda paper: encoder.encode(paper) + b'\n')
+
+    if name == 'orjson':
+        loads = orjson.loads
+        encode = lambda paper: orjson.dumps(paper, option=orjson.OPT_APPEND_NEWLINE)
+    else:
+        loads = json.loads
+        encode = lambda paper: (json.dumps(paper) + '\n').encode('utf-8')
+
+    def decodeFiltered(line, args):
+        paper = loads(line)
+        return paper if keepPaper(paper.get('year', args.year + 1), paper.get('doc_type'), args) else None
+
+    return Codec(name, loads, decodeFiltered, encode)
+
 #---------------
 
-def initializer():
-    global model
+def initializer(codecName):
+    global model, codec
     model = fasttext.load_model('./data/models/lid.176.bin')
+    codec = getCodec(codecName)
 
-def build_abstract(inverted_index):
+def build_abstract_regex(inverted_index):
 
+    # Original quote rewriting and json.loads decoder, --benchmark-abstracts compares build_abstract with it
     # Escape backslashes
     inverted_index = re.sub(r'\\', r'\\\\', inverted_index)
 
@@ -64,9 +162,66 @@ def build_abstract(inverted_index):
     # Join words
     return ' '.join(text).strip()
 
+# Layout of the indexed abstract payload
+ABSTRACT_HEAD = '{"IndexLength":'
+ABSTRACT_INDEX = ',"InvertedIndex":{"'
+ABSTRACT_TAIL = ']}}'
+
+# One "word":[positions] entry, it only ends at a digits-only position list followed by the next key or
+# the end of the payload, so '],"' or '":[' inside a word such as a citation marker '[12],' stay in the word
+ABSTRACT_ENTRY = re.compile(r'"(.*?)":\[([0-9,]*)\](?:,(?=")|}}\Z)', re.DOTALL)
+
+def build_abstract(inverted_index):
+
+    # Decode {"IndexLength":N,"InvertedIndex":{"word":[p,..],"word":[p,..]}} in one pass.
+    # All entries are found with one ABSTRACT_ENTRY scan so quotes inside a word need no
+    # escaping, they are mapped to single quotes to match build_abstract_regex
+    inverted_index = inverted_index.rstrip()
+    if not inverted_index.startswith(ABSTRACT_HEAD) or not inverted_index.endswith(ABSTRACT_TAIL):
+        return False
+
+    start = inverted_index.find(ABSTRACT_INDEX)
+    if start < 0:
+        return False
+
+    try:
+        total_length = int(inverted_index[len(ABSTRACT_HEAD):start])
+    except ValueError:
+        return False
+
+    # The scan skips text it cannot match, so the entries must add up to the rest of the payload:
+    # word and positions plus '"', '":[', '],' per entry, and the '}' left after the last ']}'
+    position = start + len(ABSTRACT_INDEX) - 1
+    entries = ABSTRACT_ENTRY.findall(inverted_index, position)
+    if sum(map(len, chain.from_iterable(entries))) + 6 * len(entries) + 1 != len(inverted_index) - position:
+        return False
+
+    # Initialize the list to store the result
+    text = [''] * total_length
+
+    # Through a dict so duplicate keys behave like json.loads (last one wins), after the quote mapping
+    words = dict(entries)
+    if '"' in ''.join(words):
+        words = {word.replace('"', "'"): positions for word, positions in entries}
+
+    # Place each word at the correct indices
+    try:
+        for word, positions in words.items():
+            if ',' not in positions:
+                if positions:
+                    text[int(positions)] = word
+            else:
+                for position in positions.split(','):
+                    text[int(position)] = word
+    except (ValueError, IndexError):
+        return False
+
+    # Join words
+    return ' '.join(text).strip()
+
 #-----
 
-def detectLang(title, abstract):
+def langText(title, abstract):
 
     # Combine title and abstract
     full_text = f"{title}: {abstract}".strip().strip(':').strip()
@@ -82,6 +237,10 @@ def detectLang(title, abstract):
         print(e)
         return False
 
+    return full_text
+
+def detectLang(full_text):
+
     # If the text is empty, exlude the paper
     if not full_text:
         return 'nan'
@@ -94,76 +253,720 @@ def detectLang(title, abstract):
         print(e)
         return False
 
+def detectLangBatch(texts):
+
+    # Failed and empty texts are resolved without the model
+    langs = [False if text is False else 'nan' for text in texts]
+    todo = [i for i, text in enumerate(texts) if text]
+
+    if not todo:
+        return langs
+
+    # Detect language for the whole block in one call
+    try:
+        labels, scores = model.predict([texts[i] for i in todo])
+    except Exception:
+        # Fall back to one call per paper so a bad text only fails itself
+        for i in todo:
+            langs[i] = detectLang(texts[i])
+        return langs
+
+    for i, label in zip(todo, labels):
+        langs[i] = label[0].replace("__label__", '')
+
+    return langs
+
+#-----
+
+# Raw dumps can be stored plain, gzipped or zstd compressed
+RAW_SUFFIXES = ('.txt', '.txt.gz', '.txt.zst')
+
+def fileIndex(file):
+    return file.split('_')[-1].split('.')[0]
+
+def isCompressed(file):
+    return file.endswith(('.gz', '.zst'))
+
+def openRaw(path, threads=4):
+
+    # Binary line stream of a raw file, decompressed on the fly
+    if path.endswith('.gz'):
+        if igzip_threaded is not None:
+            return igzip_threaded.open(path, 'rb', threads=threads)
+        return gzip.open(path, 'rb')
+
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('zstandard is required to read .zst files')
+        # Across frames, pzstd output, concatenated dumps and --compress-output shards hold many
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_size=1 << 20, read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader, buffer_size=1 << 20)
+
+    return open(path, 'rb')
+
+def skipBytes(f, count, chunk=1 << 24):
+
+    # Compressed streams can't seek, read forward to the checkpoint instead
+    while count > 0:
+        skipped = len(f.read(min(count, chunk)))
+        if not skipped:
+            break
+        count -= skipped
+
+def shardFile(file, shardBytes):
+
+    # Split a raw file into byte ranges that start and end on line boundaries
+    size = os.path.getsize(f'./data/raw/{file}')
+    bounds = [0]
+
+    # Compressed files are a single shard, their offsets can't be seeked to
+    if isCompressed(file):
+        return [0, size]
+
+    with open(f'./data/raw/{file}', 'rb') as f:
+        while bounds[-1] + shardBytes < size:
+            f.seek(bounds[-1] + shardBytes)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+
+    bounds.append(size)
+    return bounds
+
+#-----
+
+# Progress of every raw file across runs
+MANIFEST = './data/subset/manifest.json'
+
+# Per shard outputs, merged into ./data/subset/{idx}.{kind} once the file is done
+SHARD_OUTPUTS = ['papers', 'titles.jsonl', 'errors.jsonl']
+
+def shardPath(idx, shardIx, kind):
+    return f'./data/subset/{idx}.part{shardIx}.{kind}'
+
+def writeJSON(path, obj):
+
+    # Write to a temporary file first so a crash never leaves a truncated file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+def loadJSON(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def fileFingerprint(file, block=1 << 20):
+
+    # Size, mtime and a hash of the first and last blocks, hashing terabytes on every run is not an option
+    path = f'./data/raw/{file}'
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        digest.update(f.read(block))
+        f.seek(max(stat.st_size - block, 0))
+        digest.update(f.read(block))
+
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': digest.hexdigest()}
+
+def clearFile(idx):
+
+    # Remove partial outputs of a file that has to be processed from scratch
+    for name in os.listdir('./data/subset'):
+        if name.startswith(f'{idx}.part'):
+            os.remove(f'./data/subset/{name}')
+
+def mergeShards(idx, lines, args):
+
+    # Concatenate shard outputs in line order
+    if args.output_format == 'jsonl':
+
+        # zstd frames concatenate into a valid stream
+        suffix = '.zst' if args.compress_output else ''
+        with open(f'./data/subset/{idx}.jsonl{suffix}', 'wb') as out:
+            for shardIx in range(len(lines)):
+                with open(shardPath(idx, shardIx, 'papers'), 'rb') as f:
+                    shutil.copyfileobj(f, out, 1 << 24)
+    else:
+        mergeArrow(idx, len(lines), args.output_format)
+
+    with open(f'./data/subset/{idx}.titles.jsonl', 'wb') as out:
+        for shardIx in range(len(lines)):
+            with open(shardPath(idx, shardIx, 'titles.jsonl'), 'rb') as f:
+                shutil.copyfileobj(f, out, 1 << 24)
+
+    # Shift shard relative line numbers to file line numbers
+    offset = 0
+    with open(f'./data/subset/{idx}.errors.jsonl', 'w') as out:
+        for shardIx in range(len(lines)):
+            with open(shardPath(idx, shardIx, 'errors.jsonl'), 'rb') as f:
+                for line in f:
+                    err = json.loads(line)
+                    err['paper'] += offset
+                    out.write(json.dumps(err) + '\n')
+            offset += lines[shardIx]
+
+    for shardIx in range(len(lines)):
+        for kind in SHARD_OUTPUTS + ['ckpt.json']:
+            os.remove(shardPath(idx, shardIx, kind))
+
+#-----
+
+# On-disk id -> title index built from the per file title streams
+TITLE_INDEX = './data/id2title.sqlite'
+
+def buildTitleIndex(titleFiles, path=TITLE_INDEX, batchSize=100000):
+
+    # Build next to the final path and swap it in once complete
+    if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+
+    conn = sqlite3.connect(path + '.tmp')
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('CREATE TABLE id2title (id TEXT PRIMARY KEY, title TEXT) WITHOUT ROWID')
+
+    # Later files win on duplicate ids, like the dict merge did
+    batch = []
+    for titleFile in titleFiles:
+        with open(titleFile, 'rb') as f:
+            for line in f:
+                batch.append(json.loads(line))
+                if len(batch) >= batchSize:
+                    conn.executemany('INSERT OR REPLACE INTO id2title VALUES (?, ?)', batch)
+                    batch = []
+
+    conn.executemany('INSERT OR REPLACE INTO id2title VALUES (?, ?)', batch)
+    conn.commit()
+    conn.close()
+
+    os.replace(path + '.tmp', path)
+
+def loadTitleIndex(path=TITLE_INDEX):
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+def lookupTitle(index, paperId, default=None):
+    row = index.execute('SELECT title FROM id2title WHERE id = ?', (paperId,)).fetchone()
+    return default if row is None else row[0]
+
+def lookupTitles(index, paperIds, chunkSize=900):
+
+    # Query in chunks to stay under SQLite's bound parameter limit
+    paperIds = list(paperIds)
+    titles = {}
+    for i in range(0, len(paperIds), chunkSize):
+        chunk = paperIds[i:i + chunkSize]
+        titles.update(index.execute(f"SELECT id, title FROM id2title WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+    return titles
+
+def exportTitleJSON(index, path):
+
+    # Stream the index out as the id2title.json mapping without building a dict
+    with open(path, 'w') as f:
+        f.write('{')
+        for rowIx, (paperId, title) in enumerate(index.execute('SELECT id, title FROM id2title')):
+            f.write((', ' if rowIx else '') + json.dumps(paperId) + ': ' + json.dumps(title))
+        f.write('}')
+
+def peakRSS():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+#-----
+
+# Columnar output, the fixed schema of the subset
+if pa is not None:
+    PAPER_SCHEMA = pa.schema([
+        ('id', pa.string()),
+        ('title', pa.string()),
+        ('abstract', pa.string()),
+        ('year', pa.int64()),
+        ('doc_type', pa.string()),
+        ('references', pa.list_(pa.string())),
+        ('fos', pa.list_(pa.struct([('name', pa.string()), ('w', pa.float64())])))
+    ])
+
+def arrowRow(paper):
+
+    # Coerce the loosely typed dump fields to the schema: numeric ids and reference ids become strings,
+    # fields of study given as plain names become {'name': name, 'w': None}
+    row = {field: paper.get(field) for field in PAPER_SCHEMA.names}
+    row['id'] = str(row['id'])
+    if isinstance(row['references'], list):
+        row['references'] = [None if ref is None else str(ref) for ref in row['references']]
+    if isinstance(row['fos'], list):
+        row['fos'] = [{'name': fos, 'w': None} if isinstance(fos, str) else fos for fos in row['fos']]
+    return row
+
+def arrowBlock(papers):
+
+    # One record batch per block as an IPC message, appended messages form an Arrow stream.
+    # Returns the message and the (index, reason) of papers that still don't fit the schema
+    rows = [arrowRow(paper) for paper in papers]
+    try:
+        return pa.RecordBatch.from_pylist(rows, schema=PAPER_SCHEMA).serialize().to_pybytes(), []
+    except (pa.ArrowException, TypeError, ValueError):
+        pass
+
+    # Only a failed block is converted row by row to find the offending papers
+    valid, rejected = [], []
+    for paperIx, row in enumerate(rows):
+        try:
+            pa.RecordBatch.from_pylist([row], schema=PAPER_SCHEMA)
+            valid.append(row)
+        except (pa.ArrowException, TypeError, ValueError) as e:
+            rejected.append((paperIx, f'{type(e).__name__}: {e}'))
+
+    block = pa.RecordBatch.from_pylist(valid, schema=PAPER_SCHEMA).serialize().to_pybytes() if valid else b''
+    return block, rejected
+
+def mergeArrow(idx, numShards, outputFormat, rowGroupSize=100000):
+
+    # Rewrite the shard streams as one Arrow stream file or one Parquet file
+    if outputFormat == 'arrow':
+        writer = pa.ipc.new_stream(f'./data/subset/{idx}.arrow', PAPER_SCHEMA)
+    else:
+        writer = pq.ParquetWriter(f'./data/subset/{idx}.parquet', PAPER_SCHEMA, compression='zstd', use_dictionary=True)
+
+    # Buffer small batches into full row groups
+    batches, rows = [], 0
+    for shardIx in range(numShards):
+        with pa.OSFile(shardPath(idx, shardIx, 'papers'), 'rb') as f:
+            for batch in pa.ipc.open_stream(f):
+                if outputFormat == 'arrow':
+                    writer.write_batch(batch)
+                    continue
+
+                batches.append(batch)
+                rows += batch.num_rows
+                if rows >= rowGroupSize:
+                    writer.write_table(pa.Table.from_batches(batches, PAPER_SCHEMA))
+                    batches, rows = [], 0
+
+    if batches:
+        writer.write_table(pa.Table.from_batches(batches, PAPER_SCHEMA))
+    writer.close()
+
+def saveDataset(files, outputFormat, path):
+
+    # Stitch the per file shards into a directory datasets.load_from_disk can read
+    from datasets import Dataset, concatenate_datasets
+
+    paths = [f'./data/subset/{fileIndex(f)}.{outputFormat}' for f in files]
+    if outputFormat == 'arrow':
+        dataset = concatenate_datasets([Dataset.from_file(p) for p in paths])
+    else:
+        dataset = Dataset.from_parquet(paths)
+
+    dataset.save_to_disk(path)
+    return dataset
+
+#-----
+
+# Stages timed by --profile
+STAGES = ['decode', 'abstract', 'whitespace', 'normalize', 'langdetect', 'write']
+
+def timeStage(profile, stage, tick, calls=1):
+
+    # Worker stages keep [seconds, calls] so calls can count papers of a batched stage such as langdetect
+    now = perf_counter()
+    entry = profile[stage]
+    entry[0] += now - tick
+    entry[1] += calls
+    return now
+
+def summarizeProfile(profile, papers, seconds):
+    return {
+        'papers': papers,
+        'seconds': seconds,
+        'papers_per_sec': papers / max(seconds, 1e-9),
+        'stages': {stage: {'seconds': profile[stage][0], 'calls': profile[stage][1], 'share': profile[stage][0] / max(seconds, 1e-9)} for stage in STAGES}
+    }
+
 #-----
 
 def main(tup):
 
     # Unpack tuple
-    file, args = tup
+    file, shardIx, startByte, endByte, args = tup
 
     # File index
-    idx = file.split('_')[-1].split('.')[0]
+    idx = fileIndex(file)
 
-    # Title mapping
-    id2title = {}
+    # Resume from the last checkpoint of this shard
+    checkpoint = loadJSON(shardPath(idx, shardIx, 'ckpt.json')) or {
+        'position': startByte,
+        'lines': 0,
+        'kept': 0,
+        'sizes': {kind: 0 for kind in SHARD_OUTPUTS},
+        'done': False
+    }
 
-    # Abstract errors
-    errs = []
+    start = perf_counter()
+    stats = {'file': file, 'shard': shardIx, 'bytes': endByte - startByte}
 
-    # Output file
-    with open(f'./data/subset/{idx}.jsonl', 'w') as j:
-    
-        # Load data
-        with open(f'./data/raw/{file}', 'r') as f:
-            for lineIx, line in enumerate(f):
-                paper = json.loads(line)
+    if checkpoint['done']:
+        return {**stats, 'papers': checkpoint['lines'], 'kept': checkpoint['kept'], 'seconds': 0}
 
-                # Check year and document type
-                if paper.get('year', args.year + 1) <= args.year and paper.get('doc_type') != args.exclude_doc:
-
-                    # Build abstract
-                    if 'indexed_abstract' in paper:
-                        temp_abstract = build_abstract(paper['indexed_abstract'])
-                        if temp_abstract == False:
-                            errs.append({
-                                'error': 'abstract',
-                                'file': idx,
-                                'paper': lineIx,
-                                'indexed_abstract': paper['indexed_abstract']
-                            })
-                            temp_abstract = ''
-                    else:
-                        temp_abstract = ''
+    # A compressed file is one shard read to the end of its decompressed stream
+    if isCompressed(file):
+        endByte = math.inf
+
+    # Each block of papers becomes its own zstd frame so checkpoints stay on frame boundaries
+    compressor = zstandard.ZstdCompressor(level=args.zstd_level) if args.compress_output else None
+
+    # Shard outputs, anything written after the checkpoint is dropped
+    outputs = {}
+    for kind in SHARD_OUTPUTS:
+        outputs[kind] = open(shardPath(idx, shardIx, kind), 'ab')
+        outputs[kind].truncate(checkpoint['sizes'][kind])
+
+    # Arrow shards start with the schema message
+    if args.output_format != 'jsonl' and checkpoint['sizes']['papers'] == 0:
+        outputs['papers'].write(PAPER_SCHEMA.serialize().to_pybytes())
+
+    # Stage timings, None keeps the disabled path to a single check per stage
+    profile = {stage: [0.0, 0] for stage in STAGES} if args.profile else None
+
+    # Papers waiting for language detection: (lineIx, paper, text, abstract error)
+    pending = []
+
+    def flush(position, lines, done=False):
+
+        tick = perf_counter() if profile is not None else 0
+        langs = detectLangBatch([text for _, _, text, _ in pending])
+        if profile is not None:
+            tick = timeStage(profile, 'langdetect', tick, len(pending))
+
+        papers, titles, errs, keptLines = [], [], [], []
+
+        for (lineIx, paper, text, err), lang in zip(pending, langs):
+
+            if err is not None:
+                errs.append(codec.encode(err))
+
+            if lang == False:
+                errs.append(codec.encode({
+                    'error': 'langdetect',
+                    'file': idx,
+                    'paper': lineIx,
+                    'title': paper.get('title', ''),
+                    'abstract': paper.get('abstract', '')
+                }))
+
+            elif lang == args.lang:
+                
+                # Encode for the block write
+                papers.append(codec.encode(paper) if args.output_format == 'jsonl' else paper)
+                keptLines.append(lineIx)
+
+                # Update title mapping
+                titles.append(codec.encode([paper['id'], paper.get('title', '')]))
+
+        # Columnar blocks leave out papers that don't fit the schema, they are reported as errors instead
+        if args.output_format != 'jsonl':
+            papersBlock, rejected = arrowBlock(papers) if papers else (b'', [])
+            for paperIx, reason in rejected:
+                errs.append(codec.encode({
+                    'error': 'schema',
+                    'file': idx,
+                    'paper': keptLines[paperIx],
+                    'id': str(papers[paperIx].get('id')),
+                    'reason': reason
+                }))
+            rejectedIx = {paperIx for paperIx, _ in rejected}
+            titles = [title for paperIx, title in enumerate(titles) if paperIx not in rejectedIx]
+            kept = len(papers) - len(rejected)
+        else:
+            papersBlock = b''.join(papers)
+            kept = len(papers)
 
-                    paper['abstract'] = temp_abstract
-                    paper.pop('indexed_abstract', None)
+        # Write the block to file
+        for kind, block in zip(SHARD_OUTPUTS, [papersBlock, b''.join(titles), b''.join(errs)]):
+            if compressor is not None and kind == 'papers' and block:
+                block = compressor.compress(block)
+            outputs[kind].write(block)
+            outputs[kind].flush()
 
-                    # Remove whitespaces like \n, \t, etc.
-                    paper['title'] = re.sub(r'\s+', ' ', paper.get('title', '')).strip()
-                    paper['abstract'] = re.sub(r'\s+', ' ', paper.get('abstract', '')).strip()
+        pending.clear()
 
-                    # Check language
-                    lang = detectLang(paper.get('title', ''), paper.get('abstract', ''))
+        # Checkpoint after the block is on disk
+        checkpoint['position'] = position
+        checkpoint['lines'] = lines
+        checkpoint['kept'] += kept
+        checkpoint['sizes'] = {kind: outputs[kind].tell() for kind in SHARD_OUTPUTS}
+        checkpoint['done'] = done
+        writeJSON(shardPath(idx, shardIx, 'ckpt.json'), checkpoint)
 
-                    if lang == False:
-                        errs.append({
-                            'error': 'langdetect',
+        if profile is not None:
+            timeStage(profile, 'write', tick, kept)
+
+    position = checkpoint['position']
+    lineIx = checkpoint['lines'] - 1
+
+    # Load data, line numbers are relative to the shard start
+    with openRaw(f'./data/raw/{file}') as f:
+        if isCompressed(file):
+            skipBytes(f, position)
+        else:
+            f.seek(position)
+
+        for lineIx, line in enumerate(f, checkpoint['lines']):
+            if position >= endByte:
+                lineIx -= 1
+                break
+            position += len(line)
+
+            # Check year and document type before fully decoding
+            tick = perf_counter() if profile is not None else 0
+            paper = codec.decodeFiltered(line, args)
+            if profile is not None:
+                tick = timeStage(profile, 'decode', tick)
+
+            if paper is not None:
+
+                # Build abstract
+                err = None
+                if 'indexed_abstract' in paper:
+                    temp_abstract = build_abstract(paper['indexed_abstract'])
+                    if profile is not None:
+                        tick = timeStage(profile, 'abstract', tick)
+                    if temp_abstract == False:
+                        err = {
+                            'error': 'abstract',
                             'file': idx,
                             'paper': lineIx,
-                            'title': paper.get('title', ''),
-                            'abstract': paper.get('abstract', '')
-                        })
+                            'indexed_abstract': paper['indexed_abstract']
+                        }
+                        temp_abstract = ''
+                else:
+                    temp_abstract = ''
+
+                paper['abstract'] = temp_abstract
+                paper.pop('indexed_abstract', None)
+
+                # Remove whitespaces like \n, \t, etc.
+                paper['title'] = re.sub(r'\s+', ' ', paper.get('title', '')).strip()
+                paper['abstract'] = re.sub(r'\s+', ' ', paper.get('abstract', '')).strip()
+                if profile is not None:
+                    tick = timeStage(profile, 'whitespace', tick)
+
+                text = langText(paper.get('title', ''), paper.get('abstract', ''))
+                if profile is not None:
+                    timeStage(profile, 'normalize', tick)
+
+                # Queue for language detection
+                pending.append((lineIx, paper, text, err))
+                if len(pending) >= args.lang_batch_size:
+                    flush(position, lineIx + 1)
+
+        flush(position, lineIx + 1, done=True)
+
+    for output in outputs.values():
+        output.close()
+
+    # Throughput
+    return {**stats, 'papers': checkpoint['lines'], 'kept': checkpoint['kept'], 'seconds': perf_counter() - start, 'pid': os.getpid(), 'profile': profile}
+
+#-----
+
+# Checked-in decoder cases with their expected abstracts, false where the payload cannot be decoded
+ABSTRACT_CASES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'academicPapersProcessing', 'abstracts.jsonl')
+
+def benchmarkAbstract(args):
+
+    # Edge cases first: citation markers, quotes and brackets inside words, empty and malformed indexes
+    with open(ABSTRACT_CASES) as f:
+        cases = [json.loads(line) for line in f]
+    failures = [case['indexed_abstract'] for case in cases if build_abstract(case['indexed_abstract']) != case['abstract']]
+    for failure in failures:
+        print(f'Failed case: {failure}')
+    print(f'Edge cases: {len(cases) - len(failures)}/{len(cases)} decoded as expected')
+
+    # Sample raw lines that carry an indexed abstract
+    samples = []
+    for file in sorted(f for f in os.listdir('./data/raw') if f.endswith(RAW_SUFFIXES)):
+        with openRaw(f'./data/raw/{file}') as f:
+            for line in f:
+                paper = json.loads(line)
+                if 'indexed_abstract' in paper:
+                    samples.append(paper['indexed_abstract'])
+                if len(samples) >= args.benchmark_abstracts:
+                    break
+        if len(samples) >= args.benchmark_abstracts:
+            break
+
+    print(f'Benchmarking {len(samples)} abstracts...')
+
+    # Parity check against the regex + json.loads reference
+    mismatches = 0
+    for sample in samples:
+        if build_abstract(sample) != build_abstract_regex(sample):
+            mismatches += 1
+    print(f'Parity mismatches: {mismatches}')
+
+    # Timing, best of 3 runs, the regex reference is the before and build_abstract the after
+    seconds = {}
+    for name, fn in [('regex', build_abstract_regex), ('direct', build_abstract)]:
+        for _ in range(3):
+            start = perf_counter()
+            for sample in samples:
+                fn(sample)
+            seconds[name] = min(seconds.get(name, math.inf), perf_counter() - start)
+        print(f'{name}: {seconds[name]:.3f}s ({len(samples) / seconds[name]:,.0f} abstracts/sec, {seconds["regex"] / seconds[name]:.2f}x regex)')
+
+#-----
+
+def syntheticPaper(rng, paperIx):
+
+    # Random paper with the fields and sizes of a MAG/OAG dump line
+    words = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 10))) for _ in range(rng.randint(50, 250))]
+    index = {}
+    for position, word in enumerate(words):
+        index.setdefault(word, []).append(position)
+
+    return {
+        'id': str(paperIx),
+        'title': ' '.join(rng.sample(words, min(len(words), 12))).title(),
+        'authors': [{'name': f'Author {rng.randint(0, 10**6)}', 'org': 'University', 'id': str(rng.randint(0, 10**9))} for _ in range(rng.randint(1, 8))],
+        'venue': {'raw': 'Journal of Synthetic Data', 'id': str(rng.randint(0, 10**6))},
+        'year': rng.randint(1950, 2020),
+        'keywords': rng.sample(words, min(len(words), 5)),
+        'fos': [{'name': word, 'w': round(rng.random(), 4)} for word in rng.sample(words, min(len(words), 6))],
+        'references': [str(rng.randint(0, 10**9)) for _ in range(rng.randint(0, 40))],
+        'n_citation': rng.randint(0, 5000),
+        'page_start': '1',
+        'page_end': str(rng.randint(2, 30)),
+        'doc_type': rng.choice(['Journal', 'Conference', 'Patent', 'Book', '']),
+        'lang': 'en',
+        'publisher': 'Publisher',
+        'volume': str(rng.randint(1, 100)),
+        'issue': str(rng.randint(1, 12)),
+        'doi': f'10.{rng.randint(1000, 9999)}/{rng.randint(0, 10**8)}',
+        'indexed_abstract': json.dumps({'IndexLength': len(words), 'InvertedIndex': index}, separators=(',', ':'))
+    }
+
+def benchmarkCodecs(args):
 
-                    elif lang == args.lang:
-                        
-                        # Write to file
-                        json.dump(paper, j)
-                        j.write('\n')
+    # Write a synthetic MAG-style file
+    rng = random.Random(0)
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        for paperIx in range(args.benchmark_codecs):
+            f.write(json.dumps(syntheticPaper(rng, paperIx)) + '\n')
+        path = f.name
 
-                        # Update title mapping
-                        id2title[paper['id']] = paper.get('title', '')
-        
-    return id2title, errs
+    with open(path, 'rb') as f:
+        lines = f.readlines()
+    os.remove(path)
+
+    totalBytes = sum(len(line) for line in lines)
+    print(f'Benchmarking {len(lines)} synthetic papers ({totalBytes / 2**20:.1f} MB)...')
+
+    for name in CODECS[1:]:
+        if (name == 'msgspec' and msgspec is None) or (name == 'orjson' and orjson is None):
+            print(f'{name}: not installed')
+            continue
+
+        benchCodec = getCodec(name)
+
+        start = perf_counter()
+        papers = [benchCodec.decode(line) for line in lines]
+        decodeTime = perf_counter() - start
+
+        start = perf_counter()
+        kept = [paper for paper in (benchCodec.decodeFiltered(line, args) for line in lines) if paper is not None]
+        filterTime = perf_counter() - start
+
+        start = perf_counter()
+        encoded = b''.join(benchCodec.encode(paper) for paper in kept)
+        encodeTime = perf_counter() - start
+
+        print(f'{name}: decode {totalBytes / 2**20 / decodeTime:,.1f} MB/s, filtered decode {totalBytes / 2**20 / filterTime:,.1f} MB/s '
+              f'({len(kept)} kept), encode {len(encoded) / 2**20 / encodeTime:,.1f} MB/s')
+
+#-----
+
+def titleIndexMethod(tup):
+
+    # Pool worker of its own, the dict and SQLite index each get a clean ru_maxrss
+    method, titlesPath, outDir = tup
+    start = perf_counter()
+
+    if method == 'dict':
+        id2titleDict = {}
+        with open(titlesPath, 'rb') as f:
+            for line in f:
+                paperId, title = json.loads(line)
+                id2titleDict[paperId] = title
+        with open(f'{outDir}/id2title.json', 'w') as f:
+            json.dump(id2titleDict, f)
+    else:
+        buildTitleIndex([titlesPath], path=f'{outDir}/id2title.sqlite')
+
+    return perf_counter() - start, peakRSS()
+
+def benchmarkTitleIndex(args):
+
+    # Synthetic (id, title) stream shaped like the worker outputs
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as outDir:
+        titlesPath = f'{outDir}/titles.jsonl'
+        with open(titlesPath, 'w') as f:
+            for paperIx in range(args.benchmark_index):
+                f.write(json.dumps([str(rng.randint(0, 10**10)), ' '.join(rng.choices(['deep', 'learning', 'of', 'the', 'analysis', 'economic', 'growth', 'india', 'wages', 'model'], k=rng.randint(4, 15))).title()]) + '\n')
+
+        print(f'Benchmarking {args.benchmark_index} titles ({os.path.getsize(titlesPath) / 2**20:.1f} MB)...')
+
+        for method in ['dict', 'sqlite']:
+            with Pool(processes=1) as pool:
+                seconds, rss = pool.apply(titleIndexMethod, ((method, titlesPath, outDir),))
+            print(f'{method}: {seconds:.1f}s, peak RSS {rss:,.0f} MB')
+
+        index = loadTitleIndex(f'{outDir}/id2title.sqlite')
+        start = perf_counter()
+        paperIds = [paperId for paperId, in index.execute('SELECT id FROM id2title ORDER BY RANDOM() LIMIT 10000')]
+        lookupTitles(index, paperIds)
+        print(f'sqlite lookups: {len(paperIds) / (perf_counter() - start):,.0f} ids/sec')
+        index.close()
+
+#-----
+
+def benchmarkCompression(args):
+
+    # Same synthetic MAG-style papers stored plain and compressed
+    rng = random.Random(0)
+    lines = [(json.dumps(syntheticPaper(rng, paperIx)) + '\n').encode('utf-8') for paperIx in range(args.benchmark_compression)]
+    benchCodec = getCodec(args.codec)
+
+    with tempfile.TemporaryDirectory() as outDir:
+        paths = [f'{outDir}/papers.txt', f'{outDir}/papers.txt.gz']
+        with open(paths[0], 'wb') as f:
+            f.writelines(lines)
+        with gzip.open(paths[1], 'wb', compresslevel=6) as f:
+            f.writelines(lines)
+        if zstandard is not None:
+            paths.append(f'{outDir}/papers.txt.zst')
+            with zstandard.open(paths[-1], 'wb', cctx=zstandard.ZstdCompressor(level=args.zstd_level)) as f:
+                f.write(b''.join(lines))
+
+            # One frame per 1000 papers, like pzstd output and --compress-output shards
+            paths.append(f'{outDir}/papers.frames.txt.zst')
+            compressor = zstandard.ZstdCompressor(level=args.zstd_level)
+            with open(paths[-1], 'wb') as f:
+                for blockStart in range(0, len(lines), 1000):
+                    f.write(compressor.compress(b''.join(lines[blockStart:blockStart + 1000])))
+
+        print(f'Benchmarking {len(lines)} synthetic papers...')
+
+        # Wall time to stream and decode every line
+        for path in paths:
+            start = perf_counter()
+            with openRaw(path) as f:
+                count = sum(1 for line in f if benchCodec.decode(line))
+            elapsed = perf_counter() - start
+            print(f'{os.path.basename(path)}: {os.path.getsize(path) / 2**20:.1f} MB on disk, {count}/{len(lines)} papers read, {elapsed:.2f}s ({count / elapsed:,.0f} papers/sec)')
 
 #---------------
 
@@ -175,29 +978,174 @@ if __name__ == '__main__':
     parser.add_argument('--year', type=int, default=1980)
     parser.add_argument('--exclude-doc', type=str, default='Patent')
     parser.add_argument('--lang', type=str, default='en')
+    parser.add_argument('--lang-batch-size', type=int, default=512)
+    parser.add_argument('--processes', type=int, default=16)
+    parser.add_argument('--shard-mb', type=int, default=0, help='Shard size in MB, 0 picks one from the total input size')
+    parser.add_argument('--codec', type=str, default='auto', choices=CODECS)
+    parser.add_argument('--restart', action='store_true', help='Ignore the manifest and reprocess every raw file')
+    parser.add_argument('--id2title-json', action='store_true', help='Also export the title index as id2title.json')
+    parser.add_argument('--compress-output', action='store_true', help='Write zstd compressed subset shards ({idx}.jsonl.zst)')
+    parser.add_argument('--zstd-level', type=int, default=3)
+    parser.add_argument('--output-format', type=str, default='jsonl', choices=['jsonl', 'arrow', 'parquet'])
+    parser.add_argument('--dataset-dir', type=str, default=None, help='Stitch arrow/parquet shards into a load_from_disk directory')
+    parser.add_argument('--profile', action='store_true', help='Time each stage per worker and save a summary to subsetProfile.json')
+    parser.add_argument('--benchmark-abstracts', type=int, default=0, help='Compare abstract decoders on the edge cases and N raw abstracts and exit')
+    parser.add_argument('--benchmark-codecs', type=int, default=0, help='Compare JSON codecs on N synthetic papers and exit')
+    parser.add_argument('--benchmark-index', type=int, default=0, help='Compare the dict and SQLite title index on N synthetic titles and exit')
+    parser.add_argument('--benchmark-compression', type=int, default=0, help='Compare plain and compressed input on N synthetic papers and exit')
     args = parser.parse_args()
 
-    # Title mapping
-    id2titleList = []
+    # Benchmark the abstract decoders or JSON codecs instead of subsetting
+    if args.benchmark_abstracts:
+        benchmarkAbstract(args)
+        raise SystemExit
+
+    if args.benchmark_codecs:
+        benchmarkCodecs(args)
+        raise SystemExit
+
+    if args.benchmark_index:
+        benchmarkTitleIndex(args)
+        raise SystemExit
+
+    if args.benchmark_compression:
+        benchmarkCompression(args)
+        raise SystemExit
+
+    if args.compress_output and zstandard is None:
+        parser.error('--compress-output requires zstandard')
+
+    if args.compress_output and args.output_format != 'jsonl':
+        parser.error('--compress-output only applies to jsonl output')
+
+    if args.output_format != 'jsonl' and pa is None:
+        parser.error(f'--output-format {args.output_format} requires pyarrow')
+
+    # Manifest of raw files, the arguments they were subset with and their progress
+    runArgs = {'year': args.year, 'exclude_doc': args.exclude_doc, 'lang': args.lang, 'compress_output': args.compress_output, 'output_format': args.output_format}
+    manifest = (None if args.restart else loadJSON(MANIFEST)) or {'files': {}}
+
+    # Raw data files, finished ones are skipped
+    files = sorted([f for f in os.listdir('./data/raw') if f.endswith(RAW_SUFFIXES)])
+    fingerprints = {f: fileFingerprint(f) for f in files}
+    todo = [f for f in files if not (
+        f in manifest['files']
+        and manifest['files'][f]['done']
+        and manifest['files'][f]['fingerprint'] == fingerprints[f]
+        and manifest['files'][f]['args'] == runArgs
+    )]
+
+    print(f'Skipping {len(files) - len(todo)} finished files')
+
+    # Split remaining files into byte ranges of similar size
+    totalBytes = sum(fingerprints[f]['size'] for f in todo)
+    shardBytes = args.shard_mb << 20 if args.shard_mb else max(math.ceil(totalBytes / (args.processes * 4)), 16 << 20)
+
+    for f in todo:
+        entry = manifest['files'].get(f)
+
+        # Keep the shard bounds of a partial file so its checkpoints stay valid
+        if entry is None or entry['fingerprint'] != fingerprints[f] or entry['args'] != runArgs:
+            clearFile(fileIndex(f))
+            manifest['files'][f] = {
+                'fingerprint': fingerprints[f],
+                'args': runArgs,
+                'bounds': shardFile(f, shardBytes),
+                'checkpoint': 0,
+                'lines': None,
+                'kept': None,
+                'done': False
+            }
+
+        # Bytes of the file covered by finished shards, every shard of the file reports back once this run,
+        # including the ones a previous run finished
+        manifest['files'][f]['checkpoint'] = 0
+
+    writeJSON(MANIFEST, manifest)
+
+    shards = [(f, shardIx, bounds[shardIx], bounds[shardIx + 1]) for f in todo for bounds in [manifest['files'][f]['bounds']] for shardIx in range(len(bounds) - 1)]
+
+    # Stage timings per worker process
+    workerProfiles = {}
+
+    # Per file bookkeeping until all of its shards are done
+    progress = {f: {'remaining': len(manifest['files'][f]['bounds']) - 1, 'lines': {}, 'kept': 0, 'papers': 0, 'seconds': 0} for f in todo}
+
+    # Largest ranges first so the tail of the run is made of small shards
+    shards.sort(key=lambda s: s[3] - s[2], reverse=True)
+    shards = [(*shard, args) for shard in shards]
+
+    with Pool(processes=args.processes, initializer=initializer, initargs=(args.codec,)) as pool, tqdm(total=totalBytes, desc=f'Subsetting', position=0, unit='B', unit_scale=True) as pbar:
+        for stats in pool.imap_unordered(main, shards):
+            pbar.update(stats['bytes'])
+
+            state = progress[stats['file']]
+            state['lines'][stats['shard']] = stats['papers']
+            state['kept'] += stats['kept']
+            state['papers'] += stats['papers']
+            state['seconds'] += stats['seconds']
+            state['remaining'] -= 1
+
+            entry = manifest['files'][stats['file']]
+            entry['checkpoint'] += stats['bytes']
+
+            if stats.get('profile') is not None:
+                worker = workerProfiles.setdefault(stats['pid'], {'papers': 0, 'seconds': 0, 'profile': {stage: [0.0, 0] for stage in STAGES}})
+                worker['papers'] += stats['papers']
+                worker['seconds'] += stats['seconds']
+                for stage in STAGES:
+                    worker['profile'][stage][0] += stats['profile'][stage][0]
+                    worker['profile'][stage][1] += stats['profile'][stage][1]
+
+            if state['remaining'] == 0:
+                mergeShards(fileIndex(stats['file']), [state['lines'][shardIx] for shardIx in range(len(state['lines']))], args)
+
+                entry['lines'] = state['papers']
+                entry['kept'] = state['kept']
+                entry['done'] = True
+
+                pbar.write(f"[{fileIndex(stats['file'])}] {state['papers']} papers in {state['seconds']:.1f}s ({state['papers'] / max(state['seconds'], 1e-9):,.0f} papers/sec per worker)")
+                del progress[stats['file']]
+
+            writeJSON(MANIFEST, manifest)
+
+    # Title index from the per file title streams, including files finished by earlier runs
+    buildTitleIndex([f'./data/subset/{fileIndex(f)}.titles.jsonl' for f in files])
+
+    if args.id2title_json:
+        with closing(loadTitleIndex()) as index:
+            exportTitleJSON(index, './data/id2title.json')
 
     # Abstract errors
     allErrors = []
-
-    # Raw data files
-    files = sorted([(f, args) for f in os.listdir('./data/raw') if f.endswith('.txt')])
-    with Pool(processes=16, initializer=initializer) as pool, tqdm(total=len(files), desc=f'Subsetting', position=0) as pbar:
-        for out, errsOut in pool.imap_unordered(main, files):
-            id2titleList.append(out)
-            allErrors.extend(errsOut)
-            pbar.update()
+    for f in files:
+        with open(f'./data/subset/{fileIndex(f)}.errors.jsonl', 'rb') as errors:
+            allErrors.extend(json.loads(line) for line in errors)
 
     print(f'Errors: {len(allErrors)}')
 
-    # Save title mapping
-    id2titleDict = {k: v for d in id2titleList for k, v in d.items()}
-    with open(f'./data/id2title.json', 'w') as f:
-        json.dump(id2titleDict, f)
+    # Hugging Face dataset straight from the columnar shards
+    if args.dataset_dir and args.output_format != 'jsonl':
+        dataset = saveDataset(files, args.output_format, args.dataset_dir)
+        print(f'Saved {len(dataset)} papers to {args.dataset_dir}')
+
+    print(f'Peak RSS: {peakRSS():,.0f} MB')
 
     # Save errors
     with open(f'./data/subsetErrors.json', 'w') as f:
         json.dump(allErrors, f, indent=2)
+
+    # Save stage timings
+    if args.profile and workerProfiles:
+        total = {stage: [sum(w['profile'][stage][0] for w in workerProfiles.values()), sum(w['profile'][stage][1] for w in workerProfiles.values())] for stage in STAGES}
+        summary = {
+            'total': summarizeProfile(total, sum(w['papers'] for w in workerProfiles.values()), sum(w['seconds'] for w in workerProfiles.values())),
+            'workers': {pid: summarizeProfile(w['profile'], w['papers'], w['seconds']) for pid, w in workerProfiles.items()}
+        }
+
+        print(f"\nStage timings ({summary['total']['papers_per_sec']:,.0f} papers/sec per worker):")
+        for stage, timing in summary['total']['stages'].items():
+            print(f"  {stage:<12}{timing['seconds']:>10.1f}s {timing['share']:>7.1%} {timing['calls']:>12,} calls")
+
+        with open(f'./data/subsetProfile.json', 'w') as f:
+            json.dump(summary, f, indent=2)
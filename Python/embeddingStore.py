@@ -0,0 +1,229 @@
+# This script stores paper embeddings as one contiguous, memory-mappable matrix per input type, so that
+# similarity search can open millions of embeddings without unpickling them.
+
+# - Writes a .npy matrix (float32 or float16) filled split by split, next to a sorted id index.
+# - Records how many rows are written, so an interrupted run resumes after its last completed block.
+# - Reads rows by id through the sorted index and slices rows without copying.
+# - Converts the per-split pickled {id: embedding} dicts written by earlier versions of textEmbeddings.py.
+# - Benchmarks load time, lookup time and peak memory of both formats.
+
+# Highlights: NumPy memory mapping, command-line arguments
+
+import os
+import re
+import json
+import time
+import pickle
+import resource
+import argparse
+import numpy as np
+from multiprocessing import get_context
+
+#----------------------------
+
+# File names of an input type's store
+def storePaths(path, name):
+    return {
+        'embeddings': f'{path}/{name}-emb.npy',
+        'ids': f'{path}/{name}-ids.npy',
+        'rows': f'{path}/{name}-rows.npy',
+        'progress': f'{path}/{name}-progress.json'
+    }
+
+# Create the sorted id index and an empty matrix, splits then fill their rows in dataset order
+def createStore(path, name, ids, dim, dtype='float32'):
+
+    paths = storePaths(path, name)
+    if os.path.exists(paths['progress']):
+        os.remove(paths['progress'])
+
+    ids = np.asarray(ids, dtype=str)
+    order = np.argsort(ids, kind='stable')
+    np.save(paths['ids'], ids[order])
+    np.save(paths['rows'], order)
+
+    return np.lib.format.open_memmap(paths['embeddings'], mode='w+', dtype=dtype, shape=(len(ids), dim))
+
+#-------
+
+# Rows written so far and the settings they were computed with, replaced atomically after each flushed block
+def saveProgress(path, name, rows, settings=None):
+    progress = storePaths(path, name)['progress']
+    with open(progress + '.tmp', 'w') as f:
+        json.dump({'rows': rows, 'settings': settings or {}}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(progress + '.tmp', progress)
+
+def loadProgress(path, name):
+    try:
+        with open(storePaths(path, name)['progress']) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Reopen a partly written store if its ids, shape and settings match, otherwise start a new one
+def openStore(path, name, ids, dim, dtype='float32', settings=None, resume=False):
+
+    progress = loadProgress(path, name) if resume else None
+    if progress is not None and progress.get('settings') == (settings or {}):
+        paths = storePaths(path, name)
+        try:
+            store = np.lib.format.open_memmap(paths['embeddings'], mode='r+')
+            ids = np.asarray(ids, dtype=str)
+            order = np.argsort(ids, kind='stable')
+            if store.shape == (len(ids), dim) and store.dtype == np.dtype(dtype) \
+                and np.array_equal(np.load(paths['ids']), ids[order]) and np.array_equal(np.load(paths['rows']), order):
+                return store, min(int(progress['rows']), len(ids))
+        except (OSError, ValueError):
+            pass
+
+    store = createStore(path, name, ids, dim, dtype)
+    saveProgress(path, name, 0, settings)
+    return store, 0
+
+#-------
+
+class EmbeddingStore:
+
+    # Memory-mapped embeddings of one input type, nothing is read until rows are used
+    def __init__(self, path, name):
+        paths = storePaths(path, name)
+        self.embeddings = np.load(paths['embeddings'], mmap_mode='r')
+        self.ids = np.load(paths['ids'], mmap_mode='r')
+        self.rows = np.load(paths['rows'], mmap_mode='r')
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def __contains__(self, id):
+        i = np.searchsorted(self.ids, id)
+        return i < len(self.ids) and self.ids[i] == id
+
+    def row(self, id):
+        i = np.searchsorted(self.ids, id)
+        if i == len(self.ids) or self.ids[i] != id:
+            raise KeyError(id)
+        return int(self.rows[i])
+
+    # Zero-copy view of one embedding
+    def __getitem__(self, id):
+        return self.embeddings[self.row(id)]
+
+    # Copy of the embeddings of many ids, in the order given
+    def lookup(self, ids):
+        ids = np.asarray(ids, dtype=self.ids.dtype)
+        i = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        missing = self.ids[i] != ids
+        if missing.any():
+            raise KeyError(ids[missing][0])
+        return self.embeddings[self.rows[i]]
+
+    # Zero-copy view of rows start to stop, in dataset order
+    def slice(self, start, stop):
+        return self.embeddings[start:stop]
+
+#-------
+
+# Pickled splits of an input type, in split order
+def pickleSplits(path, name):
+    splits = [(int(m.group(1)), f) for f in os.listdir(path) for m in [re.fullmatch(rf'{re.escape(name)}-emb(\d+)\.pkl', f)] if m]
+    return [f'{path}/{f}' for _, f in sorted(splits)]
+
+def convertPickles(path, name, dtype='float32'):
+
+    # Ids first so the matrix can be sized, then one split at a time
+    files = pickleSplits(path, name)
+    sizes = []
+    ids = []
+    dim = None
+    for file in files:
+        with open(file, 'rb') as f:
+            split = pickle.load(f)
+        sizes.append(len(split))
+        ids.extend(split.keys())
+        if dim is None and split:
+            dim = len(next(iter(split.values())))
+
+    store = createStore(path, name, ids, dim or 0, dtype)
+
+    start = 0
+    for file, size in zip(files, sizes):
+        with open(file, 'rb') as f:
+            split = pickle.load(f)
+        if size:
+            store[start:start + size] = np.stack(list(split.values()))
+        start += size
+
+    store.flush()
+    saveProgress(path, name, len(ids))
+    return len(ids)
+
+#----------------------------
+
+def memoryMB():
+
+    # Peak resident and current anonymous MB of this process image, mapped file pages count as
+    # resident but stay shared and reclaimable page cache; ru_maxrss also counts the parent's pages before exec
+    try:
+        with open('/proc/self/status') as f:
+            fields = {line.split(':')[0]: int(line.split()[1]) / 1024 for line in f if line.startswith(('VmHWM:', 'RssAnon:'))}
+        return fields['VmHWM'], fields['RssAnon']
+    except (OSError, KeyError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return rss, rss
+
+def loadMethod(tup):
+
+    # Spawned per format, VmHWM then covers this format's load and lookups only
+    method, path, name, sample = tup
+
+    start = time.perf_counter()
+    if method == 'pkl':
+        embeddings = {}
+        for file in pickleSplits(path, name):
+            with open(file, 'rb') as f:
+                embeddings.update(pickle.load(f))
+        lookup = lambda ids: np.stack([embeddings[id] for id in ids])
+    else:
+        store = EmbeddingStore(path, name)
+        lookup = store.lookup
+    loaded = time.perf_counter()
+
+    lookup(sample)
+    return (loaded - start, time.perf_counter() - loaded, *memoryMB())
+
+def benchmark(path, name, lookups):
+
+    store = EmbeddingStore(path, name)
+    rng = np.random.default_rng(0)
+    sample = [str(id) for id in store.ids[rng.integers(0, len(store), lookups)]]
+    print(f'{name}: {len(store):,} embeddings of {store.embeddings.shape[1]} {store.embeddings.dtype}, {lookups:,} random lookups')
+
+    # Spawned, not forked, so the worker starts without this process's pages
+    for method in ['pkl', 'npy']:
+        with get_context('spawn').Pool(processes=1) as pool:
+            loadSeconds, lookupSeconds, rss, anon = pool.apply(loadMethod, ((method, path, name, sample),))
+        print(f'{name} ({method}): load {loadSeconds:.2f}s, lookups {lookupSeconds:.3f}s, peak RSS {rss:,.0f} MB, anonymous {anon:,.0f} MB')
+
+#----------------------------
+
+if __name__ == "__main__":
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--path', type=str, required=True, help='Embeddings folder of a dataset, e.g. ./data/embeddings/<dataset>')
+    parser.add_argument('--input-types', type=str, required=True, nargs='+')
+    parser.add_argument('--convert', action='store_true', help='Write a store from the pickled splits of each input type')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--benchmark', type=int, default=0, help='Compare loading the pickled splits and the store, with N random lookups')
+
+    args = parser.parse_args()
+    args.path = args.path.rstrip('/')
+
+    for name in args.input_types:
+        if args.convert:
+            print(f'{name}: {convertPickles(args.path, name, args.dtype):,} embeddings converted')
+        if args.benchmark:
+            benchmark(args.path, name, args.benchmark)
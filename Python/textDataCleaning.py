@@ -4,6 +4,9 @@
 # - Advanced regex operations to eliminate unwanted stopwords, abbreviations, and specific terms related to organizations and locations.
 # - Substitution of words and phrases based on predefined mappings, which help standardize variations of text expressions.
 # - Batch processing of data chunks in parallel to enhance performance.
+# - Cleans each distinct value once, optionally keeping cleaned values across runs in a SQLite file (--cache).
+# - Streams chunk files in row batches and writes cleaned chunks as .dta, .parquet or .feather (--output-format).
+# - Times every stage offline on synthetic rows and bundled fixture tables against a per machine baseline (--benchmark-suite).
 
 # Highlights: pandas, RegEx, NLTK, Multiprocessing
 
@@ -13,12 +16,26 @@ import pandas as pd
 
 # Helper Libraries
 import os
+import gc
+import json
+import time
+import platform
+import tempfile
+import sqlite3
+import hashlib
+import resource
+import argparse
+import threading
+from queue import Queue
 from tqdm import tqdm
 from bs4 import BeautifulSoup
-from multiprocessing import Pool
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context, get_all_start_methods
 
 # Text Libraries
 import re
+import html
 import nltk
 import unicodedata
 from nltk.corpus import stopwords
@@ -26,6 +43,10 @@ from nltk.corpus import stopwords
 # Configurations
 nltk.data.path.append("nltk_data")
 
+#Lookup tables, loaded by loadTables once the command line is parsed. --benchmark-suite uses the small bundled copies unless CLEANING_TABLES points elsewhere
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'textDataCleaning')
+TABLES_DIR = None
+
 import warnings
 warnings.filterwarnings("ignore")
 pd.options.mode.chained_assignment = None
@@ -34,20 +55,122 @@ pd.options.mode.chained_assignment = None
 
 #Cleaning Functions
 
-def multipleReplace(dict, text):
+#Word boundary tokens: runs of word characters or single other characters
+tokenPattern = re.compile(r'(\w+)|(\W)')
+
+def tokenize(s):
+    found = tokenPattern.findall(s)
+    return [w or o for w, o in found], [bool(w) for w, o in found] + [False]
+
+class TermMatcher:
+
+    #Token trie over lowercased terms, built once and matched in a single linear pass
+    #Without values matched terms are removed, with values they are replaced by values[term index]
+    def __init__(self, terms, values=None):
+        self.trie = {}
+        self.values = values
+        for priority, term in enumerate(terms):
+            tokens = tokenize(term.lower())[0]
+            if not tokens:
+                continue
+            node = self.trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node.setdefault(None, priority)
+
+    #Leftmost matches as (start, end, term index) token spans, the earliest listed term wins like in a regex alternation
+    def matches(self, tokens, isWord, start=0, stop=None):
+        i, n = start, len(tokens) if stop is None else stop
+        while i < n:
+            node = self.trie.get(tokens[i].lower())
+            end, best = -1, None
+
+            #A term has to start and end on a word boundary
+            if node is not None and isWord[i] != (i > 0 and isWord[i - 1]):
+                j = i + 1
+                while True:
+                    if None in node and isWord[j - 1] != isWord[j] and (best is None or node[None] < best):
+                        end, best = j, node[None]
+                    if j >= n:
+                        break
+                    node = node.get(tokens[j].lower())
+                    if node is None:
+                        break
+                    j += 1
+
+            if end < 0:
+                i += 1
+                continue
+
+            yield i, end, best
+            i = end
+
+    #Removal is re.sub(r'\b(term|...)\b\s*', ' ', s, flags=re.IGNORECASE), replacement is multipleReplace
+    def subTokens(self, tokens, isWord, start=0, stop=None):
+        stop = len(tokens) if stop is None else stop
+        out, last = [], start
+        for i, end, priority in self.matches(tokens, isWord, start, stop):
+            out.append(''.join(tokens[last:i]))
+            if self.values is None:
+
+                #Swallow the whitespace after the term
+                while end < stop and tokens[end].isspace():
+                    end += 1
+                out.append(' ')
+            else:
+                out.append(self.values[priority])
+            last = end
+
+        out.append(''.join(tokens[last:stop]))
+        return ''.join(out)
+
+    def sub(self, s):
+        return self.subTokens(*tokenize(s))
+
+def multipleReplaceRegex(dict, text):
+
+    #Original alternation over all keys, --benchmark checks SubstitutionEngine output against it
     replacePattern = re.compile('\\b(%s)\\b' % '|'.join(map(re.escape, dict.keys())), re.IGNORECASE)
     return replacePattern.sub(lambda mo: dict[mo.string[mo.start():mo.end()].lower()], text) 
 
+#Compile cache, filled in the parent so forked pool workers inherit the compiled tables
+@lru_cache(maxsize=None)
+def compileReplacer(items):
+
+    #Keys that aren't lowercase can never be looked up after a case-insensitive match, so they are left out
+    keys = [k for k, v in items]
+    lookup = dict(items)
+    return TermMatcher([k for k in keys if k.lower() in lookup], [lookup[k.lower()] for k in keys if k.lower() in lookup])
+
+def multipleReplace(dict, text):
+    return compileReplacer(tuple(dict.items())).sub(text)
+
+class SubstitutionEngine:
+
+    #Phrase then word substitutes, both tables compiled once. The word pass runs over the phrase pass output
+    #since a multi-token word key can span a phrase replacement and the text next to it
+    def __init__(self, phraseDict, wordDict):
+        self.phrases = compileReplacer(tuple(phraseDict.items()))
+        self.words = compileReplacer(tuple(wordDict.items()))
+
+    def sub(self, s):
+        return self.words.sub(self.phrases.sub(s))
+
 #--------
 
 #Removing Certain Words
 
 #Removing org abbrevations
-removeOrgAbbs = re.compile(r'\b(' + r'|'.join(['pvt', 'ltd', 'inc', 'lc', 'llc', 'pc', 'corp', 'co']) + r')\b\s*', re.IGNORECASE)
+orgAbbs = ['pvt', 'ltd', 'inc', 'lc', 'llc', 'pc', 'corp', 'co']
 
-#Removing stopwords
-stopWords = stopwords.words('english')
-stopWordsPattern = re.compile(r'\b(' + r'|'.join(stopWords) + r')\b\s*', re.IGNORECASE)
+#Removing stopwords, a stopwords.txt next to the tables stands in for the NLTK corpus
+def loadStopWords(tablesDir):
+    if os.path.exists(f'{tablesDir}/stopwords.txt'):
+        with open(f'{tablesDir}/stopwords.txt') as f:
+            return [w for w in f.read().splitlines() if w]
+    return stopwords.words('english')
+
+stopWords = stopWordsRemover = None
 
 #--------
 
@@ -72,45 +195,114 @@ def locationCleaning(s):
     return s
 
 #Locations
-indiaLocations = pd.read_csv('raw_data/indiaLocations.csv')
-indiaLocations['location_cleaned'] = indiaLocations['location'].apply(locationCleaning)
-indiaLocations.dropna(subset=['location_cleaned'], inplace=True)
-indiaLocations = list(indiaLocations['location_cleaned'].unique())
+def loadLocations(tablesDir):
+    indiaLocations = pd.read_csv(f'{tablesDir}/indiaLocations.csv')
+    indiaLocations['location_cleaned'] = indiaLocations['location'].apply(locationCleaning)
+    indiaLocations.dropna(subset=['location_cleaned'], inplace=True)
+    return set(indiaLocations['location_cleaned'].unique())
+
+surveyLocations_set = locationsAbbsRemover = None
 
-surveyLocations_set = set(indiaLocations)
-removeLocationsPattern = re.compile(r'\b(' + r'|'.join(surveyLocations_set) + r')\b\s*', re.IGNORECASE)
+def regexTermPatterns():
+
+    #Reference alternation patterns, only built for the --benchmark comparison
+    return [
+        re.compile(r'\b(' + r'|'.join(stopWords) + r')\b\s*', re.IGNORECASE),
+        re.compile(r'\b(' + r'|'.join(surveyLocations_set) + r')\b\s*', re.IGNORECASE),
+        re.compile(r'\b(' + r'|'.join(orgAbbs) + r')\b\s*', re.IGNORECASE)
+    ]
 
 #--------
 
 #Abbrevations#
 
 #Abbrevations
-word_substitutes = pd.read_csv('raw_data/word_substitutes.csv', encoding='latin1', header=None)
-phrase_substitutes = pd.read_csv('raw_data/phrase_substitutes.csv', encoding='latin1', header=None)
+def loadSubstitutes(tablesDir, name):
+    substitutes = pd.read_csv(f'{tablesDir}/{name}.csv', encoding='latin1', header=None)
+
+    #Making dicts with key -> value as substitute_this -> by_this_word
+    substitutesArr = [[y for y in x if pd.notna(y)] for x in substitutes.values.tolist()]
+    return {k:l[0] for l in substitutesArr for k in l[1:]}
+
+word_substitutesDict = phrase_substitutesDict = substitutionEngine = None
+
+#--------
+
+#Markup Stripping#
+
+#Characters the HTML parser acts on, plain text otherwise only loses its leading whitespace
+markupPattern = re.compile(r'[<&\r\x00\ufeff\ud800-\udfff]')
+
+#Formatting tags with plain attribute values and named or numeric entities that a regex can strip
+simpleTags = ['a', 'b', 'i', 'u', 'em', 'strong', 'p', 'br', 'hr', 'div', 'span', 'font', 'sup', 'sub', 'small', 'li', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']
+simpleAttribute = r'''\s+[A-Za-z_:][\w:.-]*(?:\s*=\s*(?:"[^"<>]*"|'[^'<>]*'|[^\s"'<>=`]+))?'''
+simpleMarkupPattern = re.compile(r'(?i:<(?:/?(?:' + '|'.join(simpleTags) + r')(?:' + simpleAttribute + r')*\s*/?)>)|(&(?:amp|lt|gt|quot|apos|nbsp|#[0-9]{1,7}|#[xX][0-9A-Fa-f]{1,6});)')
+
+#Anything left once simple markup is gone needs the full parser
+complexMarkupPattern = re.compile(r'[<\r\x00\ufeff\ud800-\udfff]|&[A-Za-z0-9#]')
+
+def simpleEntity(entity):
+
+    #None for code points the parser keeps, replaces or drops differently from html.unescape
+    if entity[1] != '#':
+        return html.unescape(entity)
+
+    n = int(entity[3:-1], 16) if entity[2] in 'xX' else int(entity[2:-1])
+    return chr(n) if 0x20 <= n < 0x7f or 0xa0 <= n < 0xd800 or 0xe000 <= n < 0xfffe else None
+
+def stripSimpleMarkup(s):
+
+    #None when the full parser is needed
+    if complexMarkupPattern.search(simpleMarkupPattern.sub('', s)):
+        return None
+
+    entities = {m.group(1): simpleEntity(m.group(1)) for m in simpleMarkupPattern.finditer(s) if m.group(1)}
+    if None in entities.values():
+        return None
+
+    return simpleMarkupPattern.sub(lambda m: entities.get(m.group(1), ''), s).lstrip(' \t\n\f')
 
-#Making dicts with key -> value as substitute_this -> by_this_word
-word_substitutesArr = [[y for y in x if pd.notna(y)] for x in word_substitutes.values.tolist()]
-word_substitutesDict = {k:l[0] for l in word_substitutesArr for k in l[1:]}
+def htmlText(s):
 
-phrase_substitutesArr = [[y for y in x if pd.notna(y)] for x in phrase_substitutes.values.tolist()]
-phrase_substitutesDict = {k:l[0] for l in phrase_substitutesArr for k in l[1:]}
+    #Same text as the lxml parser up to whitespace runs, which nameCleaning collapses right after
+    if not markupPattern.search(s):
+        return s.lstrip(' \t\n\f')
+
+    text = stripSimpleMarkup(s)
+    if text is None:
+        text = BeautifulSoup(s, 'lxml').get_text()
+
+    return text
 
 #--------
 
 #Main Cleaning Functions#
 
-def nameCleaning(s):
+def stripMarkup(s, htmlText=htmlText):
 
     #Removing links or unicodes
     try:
         s = unicodedata.normalize("NFKD", s)
-        s = BeautifulSoup(s, 'lxml').get_text()
-        s = s.decode('utf-8-sig').replace(u'\ufffd', '?')
+        s = htmlText(s)
+        s = s.decode('utf-8-sig').replace(u'�', '?')
     except:
         pass
     
     if s in ['', np.NaN, None]:
         return ''
+
+    return s
+
+def stripMarkupParser(s):
+
+    #Full parser on every value, kept for the --benchmark comparison
+    return stripMarkup(s, lambda s: BeautifulSoup(s, 'lxml').get_text())
+
+def nameCleaning(s):
+
+    s = stripMarkup(s)
+    if s == '':
+        return ''
     
     # Removing extra spaces
     s = s.strip()
@@ -123,29 +315,278 @@ def nameCleaning(s):
     s = re.sub(',', ', ', s)
 
     #Stopwords
-    s = stopWordsPattern.sub(' ', s)
+    s = stopWordsRemover.sub(s)
 
     # Removing extra spaces
     s = s.strip()
     s = re.sub('\s+', ' ', s)
 
-    s = removeLocationsPattern.sub(' ', s)
-    s = removeOrgAbbs.sub(' ', s)
+    s = locationsAbbsRemover.sub(s)
 
     s = re.sub(r'(\.\s+\.|\.+)', '.', s)
     s = re.sub('\s+', ' ', s.strip())
 
     #Standardizing Abbrevations
-    s = multipleReplace(phrase_substitutesDict, s)
-    s = multipleReplace(word_substitutesDict, s)
+    s = substitutionEngine.sub(s)
 
     s = re.sub(r'(\.\s+\.|\.+)', '.', s)
     s = re.sub('\s+', ' ', s.strip())
 
     return s
 
-def mainCleaning(df):
+#--------
+
+#Column Cleaning Functions#
+
+#Regex steps run on whole columns, through pyarrow's compute kernels when it is installed
+try:
+    import pyarrow
+    STRING_DTYPE = 'string[pyarrow]'
+except ImportError:
+    pyarrow = None
+    STRING_DTYPE = object
+
+def mapStrings(col, fn):
+    return pd.Series([fn(s) for s in col.tolist()], index=col.index, dtype=STRING_DTYPE)
+
+def collapseSpaces(col):
+    return col.str.strip().str.replace(r'\s+', ' ', regex=True)
+
+def collapseDots(col):
+    return collapseSpaces(col.str.replace(r'(\.\s+\.|\.+)', '.', regex=True))
+
+STAGES = ['markup', 'characters', 'stopwords', 'locations', 'substitutes']
+
+def timeStage(profile, stage, tick):
+
+    #Column passes accumulate seconds per stage in a flat dict, profile None only keeps the ticks going
+    now = time.perf_counter()
+    if profile is not None:
+        profile[stage] = profile.get(stage, 0) + now - tick
+    return now
+
+def nameCleaningColumn(col, profile=None):
+
+    #Unicode and HTML stripping need Python
+    tick = time.perf_counter()
+    col = mapStrings(col, stripMarkup)
+
+    # Removing extra spaces
+    col = collapseSpaces(col)
+    tick = timeStage(profile, 'markup', tick)
+
+    #Keep only certain characters
+    col = col.str.replace(r'!+', '. ', regex=True)
+    col = col.str.replace(r'\?+', '. ', regex=True)
+    col = col.str.replace(r'[^A-Za-z.,\'+&()\-/:;]+', ' ', regex=True)
+    col = col.str.replace(',', ', ', regex=False)
+    tick = timeStage(profile, 'characters', tick)
+
+    #Stopwords, locations and org abbrevations are token matches in Python
+    col = collapseSpaces(mapStrings(col, stopWordsRemover.sub))
+    tick = timeStage(profile, 'stopwords', tick)
+    col = collapseDots(mapStrings(col, locationsAbbsRemover.sub))
+    tick = timeStage(profile, 'locations', tick)
+
+    #Standardizing Abbrevations
+    col = collapseDots(mapStrings(col, substitutionEngine.sub))
+    timeStage(profile, 'substitutes', tick)
+
+    return col
+
+def cleanValues(values):
+    return values, nameCleaningColumn(pd.Series(values, dtype=object)).tolist()
+
+#--------
+
+#Workers#
 
+def workerMemory():
+
+    #Resident and private MB, private leaves out pages still shared with the parent after fork
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = {line.split()[0].rstrip(':'): int(line.split()[1]) for line in f if line.rstrip().endswith('kB')}
+        return fields['Rss'] / 1024, (fields['Private_Clean'] + fields['Private_Dirty']) / 1024
+    except (OSError, KeyError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return rss, rss
+
+def initializer(queue, created, tablesDir):
+
+    #Lookup tables are built by loadTables in the parent, forked workers share the parent's copy and spawned ones rebuild it once here
+    if TABLE_VERSION is None:
+        loadTables(tablesDir)
+    rss, private = workerMemory()
+    queue.put((os.getpid(), time.time() - created, rss, private))
+
+def startPool(processes):
+
+    #Fork where available so every worker inherits the tables already built in this process,
+    #frozen objects stay out of the workers' garbage collections which would otherwise copy their pages
+    context = get_context('fork' if 'fork' in get_all_start_methods() else None)
+    gc.freeze()
+
+    queue = context.Queue()
+    pool = context.Pool(processes=processes, initializer=initializer, initargs=(queue, time.time(), TABLES_DIR))
+    stats = [queue.get() for _ in range(processes)]
+
+    ready = max(s[1] for s in stats)
+    rss = sum(s[2] for s in stats) / processes
+    private = sum(s[3] for s in stats) / processes
+    print(f'Pool ({context.get_start_method()}): {processes} workers ready in {ready:.2f}s, {rss:,.0f} MB resident, {private:,.0f} MB private per worker')
+    
+    return pool
+
+#--------
+
+#Cleaning Cache#
+
+#Bump when the cleaning steps change, table edits are picked up by the hash
+CLEANING_VERSION = 1
+TABLE_VERSION = None
+
+def loadTables(tablesDir):
+
+    #Matchers and the table hash, built once before any cleaning or pool start
+    global TABLES_DIR, stopWords, stopWordsRemover, surveyLocations_set, locationsAbbsRemover
+    global word_substitutesDict, phrase_substitutesDict, substitutionEngine, TABLE_VERSION
+
+    TABLES_DIR = tablesDir
+    stopWords = loadStopWords(tablesDir)
+    stopWordsRemover = TermMatcher(stopWords)
+
+    #Locations and org abbrevations share one matcher, stopwords go first since names like 'daman and diu' only match once they are gone
+    surveyLocations_set = loadLocations(tablesDir)
+    locationsAbbsRemover = TermMatcher(list(surveyLocations_set) + orgAbbs)
+
+    word_substitutesDict = loadSubstitutes(tablesDir, 'word_substitutes')
+    phrase_substitutesDict = loadSubstitutes(tablesDir, 'phrase_substitutes')
+    substitutionEngine = SubstitutionEngine(phrase_substitutesDict, word_substitutesDict)
+
+    TABLE_VERSION = hashlib.sha1(json.dumps([
+        CLEANING_VERSION, stopWords, sorted(surveyLocations_set), orgAbbs,
+        sorted(phrase_substitutesDict.items()), sorted(word_substitutesDict.items())
+    ]).encode()).hexdigest()
+
+class CleaningCache:
+
+    #Cleaned value per raw value, kept in memory across chunks and optionally in SQLite across runs
+    def __init__(self, path=None, maxEntries=None):
+        self.memory = {}
+        self.maxEntries = maxEntries
+        self.stats = {'rows': 0, 'unique': 0, 'memory': 0, 'disk': 0, 'cleaned': 0}
+        self.conn = None
+
+        if path:
+            self.conn = sqlite3.connect(path)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS cleaned (hash TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+
+            #Entries from other table versions are stale
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None or row[0] != TABLE_VERSION:
+                self.conn.execute('DELETE FROM cleaned')
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (TABLE_VERSION,))
+                self.conn.commit()
+
+    @staticmethod
+    def key(value):
+        return hashlib.sha1(str(value).encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def missing(self, values):
+
+        new = [v for v in values if v not in self.memory]
+        self.stats['memory'] += len(values) - len(new)
+
+        if self.conn is not None and new:
+            keys = {self.key(v): v for v in new}
+            hashes = list(keys)
+            for i in range(0, len(hashes), 900):
+                chunk = hashes[i:i + 900]
+                query = f'SELECT hash, value FROM cleaned WHERE hash IN ({",".join("?" * len(chunk))})'
+                for h, cleaned in self.conn.execute(query, chunk):
+                    self.memory[keys[h]] = cleaned
+            
+            found = len(new)
+            new = [v for v in new if v not in self.memory]
+            self.stats['disk'] += found - len(new)
+
+        return new
+
+    def store(self, values, cleaned):
+        self.memory.update(zip(values, cleaned))
+        self.stats['cleaned'] += len(values)
+
+        if self.conn is not None:
+            self.conn.executemany('INSERT OR REPLACE INTO cleaned VALUES (?, ?)', [(self.key(v), c) for v, c in zip(values, cleaned)])
+
+    def evict(self):
+
+        #Emptied between batches only, values cleaned for a batch have to stay until its columns are looked up
+        if self.maxEntries is not None and len(self.memory) > self.maxEntries:
+            self.memory.clear()
+
+    def clean(self, values, rows, pool=None, pbar=None, parts=32):
+
+        #Values are unique, rows is how many rows they stand for
+        self.stats['rows'] += rows
+        self.stats['unique'] += len(values)
+        missing = self.missing(values)
+        if pbar is not None:
+            pbar.update(len(values) - len(missing))
+
+        if pool is None:
+            if missing:
+                self.store(*cleanValues(missing))
+        else:
+            for part, cleaned in pool.imap_unordered(cleanValues, [x.tolist() for x in np.array_split(np.array(missing, dtype=object), parts) if len(x)]):
+                self.store(part, cleaned)
+                if pbar is not None:
+                    pbar.update(len(part))
+
+        if self.conn is not None:
+            self.conn.commit()
+
+    def cleanColumn(self, col, cleaned=False):
+        #Values an earlier clean call already counted are only looked up, anything else goes through clean
+        if not cleaned:
+            self.clean(pd.unique(col), len(col))
+        return pd.Series(col.map(self.memory), index=col.index, dtype=STRING_DTYPE)
+
+    def summary(self):
+        s = self.stats
+        dedupe = 1 - s['unique'] / s['rows'] if s['rows'] else 0
+        hits = (s['memory'] + s['disk']) / s['unique'] if s['unique'] else 0
+        return (f"{s['rows']:,} rows, {s['unique']:,} unique ({dedupe:.1%} deduped), "
+                f"{s['memory']:,} memory hits, {s['disk']:,} disk hits, {s['cleaned']:,} cleaned ({hits:.1%} hit rate)")
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+#--------
+
+def mainCleaning(df, cache=None, cleaned=False):
+
+    #Repeated names and descriptions are cleaned once, cleaned when the caller already ran cache.clean on this batch
+    cache = cache if cache is not None else CleaningCache()
+    df['name_clean'] = cache.cleanColumn(df['name'], cleaned)
+    df['desc_clean'] = cache.cleanColumn(df['desc'], cleaned)
+
+    #Blank placeholder values
+    for col in ['name_clean', 'desc_clean']:
+        df[col] = df[col].mask(df[col].str.lower().isin(['other', 'not mentioned']), '')
+
+    nameDesc = collapseDots(df['name_clean'] + '. ' + df['desc_clean'])
+    df['nameDesc_clean'] = nameDesc.mask(nameDesc.str.strip() == '.', '').astype(object)
+
+    df.drop(columns=['name', 'desc', 'name_clean', 'desc_clean'], inplace=True)
+    return df
+
+def mainCleaningApply(df):
+
+    #Row by row reference, kept for the --benchmark comparison
     df['name_clean'] = df['name'].apply(nameCleaning)
     df['desc_clean'] = df['desc'].apply(nameCleaning)
     
@@ -161,27 +602,407 @@ def mainCleaning(df):
 
 #---------------------------
 
-if __name__ == '__main__':
+#Pipeline
 
-    for file in tqdm(sorted([x for x in os.listdir('raw_data/scrapedData_chunks') if x.endswith('.dta')]), position=0, desc='Data Chunks'):
+def readBatches(files, batchRows):
 
+    #Needed columns a batch of rows at a time, then None once a file is done
+    for file in files:
         num = int(file.replace('.dta', ''))
+        with pd.read_stata(f'raw_data/scrapedData_chunks/{file}', columns=['uniqueId', 'name', 'desc'], iterator=True, chunksize=batchRows) as reader:
+            for batch in reader:
+                yield num, batch
+        yield num, None
 
-        # Load data
-        raw = pd.read_stata(f'raw_data/scrapedData_chunks/{file}', columns=['uniqueId', 'name', 'desc'])
-        raw.sort_values(by=['uniqueId'], inplace=True, ignore_index=True)
-        raw['desc'] = raw['desc'].astype(str)
+def prefetch(items, size):
 
-        # Chunk data
-        chunks = np.array_split(raw, 32)
-        data = []
+    #Runs the iterator in a background thread at most size items ahead
+    buffer = Queue(maxsize=size)
+    done = object()
 
-        with Pool(processes=32) as pool, tqdm(total=len(raw), position=num, desc=f'Cleaning Data [{num}]') as pbar:
+    def produce():
+        try:
+            for item in items:
+                buffer.put((item, None))
+            buffer.put((done, None))
+        except BaseException as e:
+            buffer.put((None, e))
 
-            for clean_df in pool.imap_unordered(mainCleaning, chunks):
-                data.append(clean_df)
-                pbar.update(len(clean_df))
-            
-        df = pd.concat(data, ignore_index=True)
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        item, error = buffer.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+#Output writers, the same uniqueId and nameDesc_clean columns in each format
+def writeDta(df, path):
+    df.to_stata(path, version=118, write_index=False)
+
+def writeParquet(df, path):
+    #Repeated names are stored once per row group
+    df.to_parquet(path, engine='pyarrow', index=False, use_dictionary=True, compression='zstd')
+
+def writeFeather(df, path):
+    df.to_feather(path, compression='zstd')
+
+WRITERS = {'dta': writeDta, 'parquet': writeParquet, 'feather': writeFeather}
+
+def writeChunk(data, num, outputFormat='dta'):
+
+    #Batches are cleaned in file order, so rows only need sorting when the file itself is out of id order
+    df = pd.concat(data, ignore_index=True)
+    if not df['uniqueId'].is_monotonic_increasing:
         df.sort_values(by=['uniqueId'], inplace=True, ignore_index=True)
-        df.to_stata(f'nameData_chunks/names_clean_{num}.dta', version=118, write_index=False)
+
+    WRITERS[outputFormat](df, f'nameData_chunks/names_clean_{num}.{outputFormat}')
+
+#---------------------------
+
+#Benchmarks
+
+def benchmarkSample(n):
+
+    #First n rows of the first scraped chunk, prepared like the main loop does
+    file = sorted([x for x in os.listdir('raw_data/scrapedData_chunks') if x.endswith('.dta')])[0]
+    raw = pd.read_stata(f'raw_data/scrapedData_chunks/{file}', columns=['uniqueId', 'name', 'desc']).head(n)
+    raw['desc'] = raw['desc'].astype(str)
+    return raw
+
+def timeRows(fn, values):
+    start = time.perf_counter()
+    out = [fn(s) for s in values]
+    return out, len(values) / (time.perf_counter() - start)
+
+def benchmark(args):
+
+    sample = benchmarkSample(args.benchmark)
+    values = [str(s) for s in sample['name'].tolist() + sample['desc'].tolist()]
+    print(f'Benchmarking {len(values)} name/desc values...')
+
+    #Markup stripping on the sample plus copies wrapped in simple and in parser-only markup
+    rng = np.random.default_rng(0)
+    wrapped = []
+    for s in values:
+        tag, entity = rng.choice(simpleTags), rng.choice(['&amp;', '&nbsp;', '&#39;', '&quot;'])
+        wrapped += [f'<{tag}>{s}</{tag}> {entity} <br/>{s}', f'<a href="#">{s}</a><table><td>{s}&ampx']
+
+    def markupPath(s):
+        s = unicodedata.normalize("NFKD", s)
+        if not markupPattern.search(s):
+            return 'plain text'
+        return 'simple markup' if stripSimpleMarkup(s) is not None else 'full parser'
+
+    #Whitespace runs are collapsed right after this stage in nameCleaning
+    spaces = lambda s: re.sub('\s+', ' ', s).strip()
+
+    paths = {}
+    for s in values + wrapped:
+        paths.setdefault(markupPath(s), []).append(s)
+
+    for path, inputs in paths.items():
+        parserOut, parserRate = timeRows(stripMarkupParser, inputs)
+        stripOut, stripRate = timeRows(stripMarkup, inputs)
+        mismatches = sum(spaces(a) != spaces(b) for a, b in zip(parserOut, stripOut))
+        print(f'Markup ({path}, {len(inputs)} rows): parser {parserRate:,.0f} rows/sec, stripMarkup {stripRate:,.0f} rows/sec, {mismatches} mismatches')
+
+    #Term removal stage on text that went through the character filter
+    filtered = [re.sub(r'[^A-Za-z.,\'+&()\-/:;]+', ' ', s) for s in values]
+
+    start = time.perf_counter()
+    patterns = regexTermPatterns()
+    print(f'Regex compile: {time.perf_counter() - start:.2f}s')
+
+    def regexChain(s):
+        s = patterns[0].sub(' ', s)
+        s = re.sub('\s+', ' ', s.strip())
+        s = patterns[1].sub(' ', s)
+        return patterns[2].sub(' ', s)
+
+    def termRemover(s):
+        s = stopWordsRemover.sub(s)
+        s = re.sub('\s+', ' ', s.strip())
+        return locationsAbbsRemover.sub(s)
+
+    #Whitespace left between removed terms is collapsed right after this stage in nameCleaning
+    collapse = lambda s: re.sub('\s+', ' ', re.sub(r'(\.\s+\.|\.+)', '.', s).strip())
+
+    regexOut, regexRate = timeRows(regexChain, filtered)
+    trieOut, trieRate = timeRows(termRemover, filtered)
+    mismatches = sum(collapse(a) != collapse(b) for a, b in zip(regexOut, trieOut))
+
+    print(f'Term removal: regex {regexRate:,.0f} rows/sec, trie {trieRate:,.0f} rows/sec, {mismatches} mismatches')
+
+    #Substitutes on the sample and on every table key dropped into random context with random casing
+    keys = list(phrase_substitutesDict) + list(word_substitutesDict)
+    context = [s for s in filtered if s.strip()] or ['']
+    synthetic = []
+    for key in keys:
+        left, right = rng.choice(context), rng.choice(context)
+        cased = ''.join(c.upper() if rng.random() < 0.3 else c for c in key)
+        synthetic += [key, f'{left} {cased} {right}', f'{cased},{key}.{right}']
+
+    def regexPasses(s):
+        try:
+            return multipleReplaceRegex(word_substitutesDict, multipleReplaceRegex(phrase_substitutesDict, s))
+        except KeyError:
+            return None
+
+    for name, inputs in [('sample', filtered), ('table keys', synthetic)]:
+        regexOut, regexRate = timeRows(regexPasses, inputs)
+        engineOut, engineRate = timeRows(substitutionEngine.sub, inputs)
+        mismatches = sum(a is not None and a != b for a, b in zip(regexOut, engineOut))
+        print(f'Substitutes ({name}, {len(inputs)} rows): regex {regexRate:,.0f} rows/sec, engine {engineRate:,.0f} rows/sec, {mismatches} mismatches')
+
+    #Small constructed tables with multi-token keys, so word keys also span phrase replacements and the text next to them
+    tokens, separators = ['a', 'b', 'co-op', 'seva', 'sangh'], [' ', ',', '-', '. ']
+    phraseOf = lambda n: ''.join(rng.choice(separators) + rng.choice(tokens) for _ in range(n))[1:].strip()
+    cases = mismatches = 0
+    for _ in range(2000):
+        phraseDict = {phraseOf(rng.integers(1, 4)): phraseOf(rng.integers(1, 3)) for _ in range(3)}
+        wordDict = {phraseOf(rng.integers(1, 4)): phraseOf(rng.integers(1, 3)) for _ in range(3)}
+        engine = SubstitutionEngine(phraseDict, wordDict)
+        for _ in range(5):
+            s = phraseOf(rng.integers(1, 8))
+            try:
+                expected = multipleReplaceRegex(wordDict, multipleReplaceRegex(phraseDict, s))
+            except KeyError:
+                continue
+            cases += 1
+            mismatches += engine.sub(s) != expected
+    print(f'Substitutes (constructed tables, {cases} rows): {mismatches} mismatches')
+
+    #Whole function
+    _, rate = timeRows(nameCleaning, values)
+    print(f'nameCleaning: {rate:,.0f} rows/sec')
+
+    #Chunk cleaning on one core: row by row, unique values only, then again with every value cached
+    cache = CleaningCache()
+    results = {}
+    for name, fn in [('apply', mainCleaningApply), ('deduped', lambda df: mainCleaning(df, cache)), ('cached', lambda df: mainCleaning(df, cache))]:
+        start = time.perf_counter()
+        results[name] = fn(sample.copy())
+        print(f'mainCleaning ({name}): {len(sample) / (time.perf_counter() - start):,.0f} rows/sec per core')
+
+    for name in ['deduped', 'cached']:
+        mismatches = (results['apply']['nameDesc_clean'] != results[name]['nameDesc_clean']).sum()
+        print(f'mainCleaning ({name}) mismatches: {mismatches}')
+
+    print(f'Cleaning cache: {cache.summary()}')
+
+    #Output formats on the cleaned sample, read back too since downstream matching reads these files repeatedly
+    readers = {'dta': pd.read_stata, 'parquet': pd.read_parquet, 'feather': pd.read_feather}
+    cleaned = results['deduped'].sort_values(by=['uniqueId'], ignore_index=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        for outputFormat, write in WRITERS.items():
+            if outputFormat != 'dta' and pyarrow is None:
+                continue
+            path = os.path.join(tmp, f'names_clean.{outputFormat}')
+            start = time.perf_counter()
+            write(cleaned.copy(), path)
+            written = time.perf_counter()
+            readers[outputFormat](path)
+            print(f'Output ({outputFormat}): write {written - start:.2f}s, read {time.perf_counter() - written:.2f}s, {os.path.getsize(path) / 2**20:.1f} MB')
+
+#---------------------------
+
+#Benchmark Suite
+
+#Words around the table terms in synthetic names and descriptions
+syntheticWords = ['mahila', 'kisan', 'vikas', 'samiti', 'farmers', 'women', 'producer', 'welfare', 'rural', 'education', 'trust',
+                  'seva', 'sangh', 'youth', 'health', 'livelihood', 'dairy', 'handloom', 'artisans', 'training', 'savings', 'credit']
+syntheticMarkup = [('<p>', '</p>'), ('<b>', '</b>'), ('<span class="desc">', '</span>'), ('<a href="https://example.org/shg?id=7&amp;p=2">', '</a>'),
+                   ('<div><br/>', '</div>'), ('<table><tr><td>', '</td></tr></table>'), ('<!-- scraped -->', '')]
+syntheticEntities = ['&amp;', '&nbsp;', '&#39;', '&quot;', ' & ']
+
+def syntheticRows(n, seed=0):
+
+    #Scraped looking rows built from the loaded tables, names repeat the way org and scheme names do
+    rng = np.random.default_rng(seed)
+    locations = sorted(surveyLocations_set)
+    terms = sorted(word_substitutesDict) + sorted(phrase_substitutesDict)
+
+    def pick(items):
+        return items[rng.integers(len(items))]
+
+    def cased(s):
+        r = rng.random()
+        return s if r < 0.5 else s.title() if r < 0.9 else s.upper()
+
+    def name():
+        parts = [cased(pick(syntheticWords)) for _ in range(rng.integers(1, 4))]
+        parts.insert(rng.integers(0, len(parts) + 1), cased(pick(terms)))
+        if rng.random() < 0.5:
+            parts.append(cased(pick(orgAbbs)) + pick(['', '.']))
+        if rng.random() < 0.6:
+            parts.append(', ' + cased(pick(locations)))
+        return ' '.join(parts)
+
+    def desc():
+        words = []
+        for _ in range(rng.integers(8, 40)):
+            r = rng.random()
+            words.append(pick(stopWords) if r < 0.4 else pick(syntheticWords) if r < 0.7 else pick(terms) if r < 0.85 else pick(locations))
+        s = ' '.join(cased(w) for w in words) + pick(['.', '!!', '??', '...', ''])
+        if rng.random() < 0.25:
+            before, after = pick(syntheticMarkup)
+            s = f'{before}{s}{pick(syntheticEntities)}{after}'
+        return s
+
+    names, descs = [], []
+    for _ in range(n):
+        names.append(pick(names) if names and rng.random() < 0.3 else name())
+        r = rng.random()
+        descs.append(pick(descs) if descs and r < 0.2 else pick(['Other', 'Not Mentioned', 'nan']) if r < 0.25 else desc())
+
+    return pd.DataFrame({'uniqueId': np.arange(n, dtype=np.int32), 'name': names, 'desc': descs})
+
+def suiteRates(sample):
+
+    #Rows per second for each stage over every value, then the whole column pass and the deduped chunk cleaning
+    values = pd.Series(sample['name'].tolist() + sample['desc'].tolist(), dtype=object)
+    profile = {}
+
+    gc.collect()
+    start = time.perf_counter()
+    nameCleaningColumn(values, profile)
+    rates = {f'stage {stage}': len(values) / profile[stage] for stage in STAGES}
+    rates['nameCleaningColumn'] = len(values) / (time.perf_counter() - start)
+
+    gc.collect()
+    start = time.perf_counter()
+    mainCleaning(sample.copy())
+    rates['mainCleaning'] = len(sample) / (time.perf_counter() - start)
+
+    return rates
+
+def benchmarkSuite(args):
+
+    sample = syntheticRows(args.suite_rows)
+    print(f'Benchmark suite: {len(sample)} synthetic rows, tables from {TABLES_DIR}, best of {args.suite_repeats}')
+
+    #Best of the repeats, the first one also warms the compile caches
+    rates = {}
+    for _ in range(args.suite_repeats):
+        for key, rate in suiteRates(sample).items():
+            rates[key] = max(rates.get(key, 0), rate)
+
+    result = {
+        'rows': len(sample),
+        'tables': TABLE_VERSION,
+        'machine': f'{platform.node()} {platform.machine()} {os.cpu_count()} cpus',
+        'python': platform.python_version(),
+        'rates': rates
+    }
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as f:
+            json.dump(result, f, indent=4)
+        for key, rate in rates.items():
+            print(f'{key:<22}{rate:>12,.0f} rows/sec')
+        print(f'Baseline saved to {args.baseline}')
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    #Throughput only compares on the same machine, tables and sample size
+    for key, label in [('machine', 'machine'), ('tables', 'lookup tables'), ('rows', 'sample size')]:
+        if baseline[key] != result[key]:
+            print(f'Note: {label} differ from the baseline ({baseline[key]} vs {result[key]})')
+
+    regressions = []
+    for key, rate in rates.items():
+        before = baseline['rates'].get(key)
+        if before is None:
+            print(f'{key:<22}{rate:>12,.0f} rows/sec  (not in baseline)')
+            continue
+        change = rate / before - 1
+        flag = change < -args.threshold
+        if flag:
+            regressions.append(key)
+        print(f'{key:<22}{rate:>12,.0f} rows/sec  {change:+7.1%} vs {before:,.0f}{"  REGRESSION" if flag else ""}')
+
+    if regressions:
+        print(f'{len(regressions)} stages slower than the baseline by more than {args.threshold:.0%}')
+        raise SystemExit(1)
+
+#---------------------------
+
+if __name__ == '__main__':
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', type=int, default=0, help='Time the cleaning stages on N sampled rows and exit')
+    parser.add_argument('--benchmark-suite', action='store_true', help='Time every stage on synthetic rows and the bundled fixture tables (or CLEANING_TABLES) against a stored baseline and exit')
+    parser.add_argument('--suite-rows', type=int, default=20000, help='Synthetic rows for --benchmark-suite')
+    parser.add_argument('--suite-repeats', type=int, default=5, help='Runs per stage, the fastest one is kept')
+    parser.add_argument('--baseline', type=str, default='benchmark_baseline.json', help='Stored rates of this machine to compare against, written by the first run')
+    parser.add_argument('--save-baseline', action='store_true', help='Overwrite the baseline with this run')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Slowdown beyond which a stage counts as a regression')
+    parser.add_argument('--cache', type=str, default=None, help='SQLite file keeping cleaned values across runs')
+    parser.add_argument('--processes', type=int, default=32, help='Cleaning workers, started once for all chunk files')
+    parser.add_argument('--batch-rows', type=int, default=1000000, help='Rows read from a chunk file at a time')
+    parser.add_argument('--prefetch', type=int, default=2, help='Row batches read ahead while the current one is cleaned')
+    parser.add_argument('--output-format', type=str, default='dta', choices=list(WRITERS), help='File format of the cleaned chunks')
+    parser.add_argument('--cache-entries', type=int, default=5000000, help='Cleaned values kept in memory before the cache is emptied')
+    args = parser.parse_args()
+
+    if args.output_format != 'dta' and pyarrow is None:
+        parser.error(f'--output-format {args.output_format} needs pyarrow')
+
+    loadTables(os.getenv('CLEANING_TABLES') or (FIXTURES_DIR if args.benchmark_suite else 'raw_data'))
+
+    if args.benchmark:
+        benchmark(args)
+        raise SystemExit
+
+    if args.benchmark_suite:
+        benchmarkSuite(args)
+        raise SystemExit
+
+    cache = CleaningCache(args.cache, args.cache_entries)
+    pool = startPool(args.processes)
+
+    # Reading the next batches and writing finished files overlap with cleaning
+    files = sorted([x for x in os.listdir('raw_data/scrapedData_chunks') if x.endswith('.dta')])
+    writer = ThreadPoolExecutor(max_workers=1)
+    pending = None
+    data = []
+
+    with tqdm(total=len(files), position=0, desc='Data Chunks') as fileBar, tqdm(position=1, desc='Cleaning Data', unit=' rows') as rowBar:
+
+        for num, batch in prefetch(readBatches(files, args.batch_rows), args.prefetch):
+
+            # File done, at most one finished file waits on the writer
+            if batch is None:
+                if pending is not None:
+                    pending.result()
+                pending = writer.submit(writeChunk, data, num, args.output_format)
+                data = []
+                fileBar.update(1)
+                continue
+
+            batch['desc'] = batch['desc'].astype(str)
+
+            # Clean unique values not already cached, the cache is emptied first once it holds too many
+            values = pd.unique(pd.concat([batch['name'], batch['desc']], ignore_index=True))
+            cache.evict()
+            cache.clean(values, 2 * len(batch), pool, parts=args.processes)
+
+            data.append(mainCleaning(batch, cache, cleaned=True))
+            rowBar.set_description(f'Cleaning Data [{num}]')
+            rowBar.update(len(batch))
+
+    if pending is not None:
+        pending.result()
+    writer.shutdown()
+
+    pool.close()
+    pool.join()
+
+    print(f'Cleaning cache: {cache.summary()}')
+    cache.close()
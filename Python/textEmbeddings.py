@@ -3,18 +3,24 @@
 # GPU processing for efficiency.
 
 # - Filters and processes datasets based on specified textual components (e.g., title, abstract).
-# - Utilizes GPU for accelerated computation if available.
+# - Utilizes GPU for accelerated computation if available, or several CPU worker processes sharing one model copy.
+# - Can tokenize each text field once, cached on disk, and assemble every input type from the cached token ids.
 # - Supports splitting large datasets into manageable segments for efficient processing.
-# - Computes embeddings using pretrained transformer models and pickles them for further use.
+# - Writes embeddings to disk in fixed-size blocks as they finish, and resumes an interrupted run from the last completed block.
+# - Computes embeddings using pretrained transformer models and stores them as memory-mappable matrices for further use.
+# - Runs the model through eager PyTorch, int8 dynamically quantized PyTorch, or an exported ONNX Runtime graph.
 # - Configurable through command line arguments for flexibility in different research scenarios.
 
-# Highlights: Hugging Face, PyTorch, GPU processing, command-line arguments
+# Highlights: Hugging Face, PyTorch, GPU processing, ONNX Runtime, multiprocessing, command-line arguments
 
 import os
 import re
 import gc
+import time
+import shutil
 import pickle
 import argparse
+import numpy as np
 from tqdm import tqdm
 from copy import deepcopy
 from pprint import pprint
@@ -24,6 +30,15 @@ from datasets import load_from_disk
 from adapters import AutoAdapterModel
 from transformers import AutoTokenizer
 from torch.utils.data import DataLoader
+from multiprocessing import get_context, get_all_start_methods
+
+# ONNX Runtime backend, optional
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+from embeddingStore import openStore, saveProgress
 
 #----------------------------
 
@@ -59,67 +74,332 @@ def splitIndices(total, splits):
 
 #-------
 
-def computeEmbeddings(name, splitIdx, model, dataset, args):
+# Group indices of similar token length into batches, capped by padded tokens or by count
+def lengthBatches(lengths, maxTokens, batchSize):
+
+    # Longest first, so the largest batch runs before anything is computed
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches = []
+    batch = []
+    for i in order:
+        if batch and (lengths[batch[0]] * (len(batch) + 1) > maxTokens if maxTokens else len(batch) >= batchSize):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+# Padded tokens and attention cost (batch x length^2) of a batching
+def batchCost(lengths, batches):
+    longest = [max(lengths[i] for i in batch) for batch in batches]
+    tokens = sum(len(batch) * n for batch, n in zip(batches, longest))
+    attention = sum(len(batch) * n * n for batch, n in zip(batches, longest))
+    return tokens, attention
+
+#-------
+
+# File name part for a model or adapter name or path
+def fileName(name):
+    return re.sub(r'[^\w.-]+', '--', name.strip('/'))
+
+# CLS embeddings of the adapter model, the graph exported for ONNX Runtime
+class CLSEmbedding(torch.nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, 0, :]
+
+def quantizeModel(model):
+
+    # The adapters library wraps the attention and feed-forward linears in LoRA layers, which quantize_dynamic
+    # skips as it matches exact types, without LoRA weights of their own they are plain linears sharing the weights
+    model = deepcopy(model)
+    for module in list(model.modules()):
+        for childName, child in module.named_children():
+            if hasattr(child, 'loras') and not child.loras and isinstance(child, torch.nn.Linear) and not child.fan_in_fan_out:
+                linear = torch.nn.Linear(child.in_features, child.out_features, bias=child.bias is not None, device='meta')
+                linear.weight, linear.bias = child.weight, child.bias
+                setattr(module, childName, linear)
+
+    # int8 weights for the linear layers, activations are quantized on the fly per batch
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def exportOnnx(model, path):
+
+    # The active adapter is traced into the graph, so ONNX Runtime needs neither adapters nor PyTorch weights,
+    # the wrapper must be in eval mode as the exporter restores its mode on the model
+    if not os.path.exists(path):
+        encoder = CLSEmbedding(model).eval()
+        example = torch.ones((2, 16), dtype=torch.long)
+        torch.onnx.export(
+            encoder, (example, example), path + '.tmp', dynamo=False, opset_version=17,
+            input_names=['input_ids', 'attention_mask'], output_names=['embedding'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'embedding': {0: 'batch'}}
+        )
+        os.replace(path + '.tmp', path)
+
+    return path
+
+def onnxSession(path, threads):
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+#-------
+
+def embedBatch(model, batch):
+
+    # ONNX Runtime session, the graph already returns the CLS embeddings
+    if onnxruntime is not None and isinstance(model, onnxruntime.InferenceSession):
+        return model.run(['embedding'], {k: v.numpy() for k, v in batch.items()})[0]
+
+    # Move batch to the same device as model
+    batch = {k: v.to(model.device) for k, v in batch.items()}
+
+    # Generate embeddings
+    outputs = model(**batch)
+
+    # Move embeddings to CPU
+    return outputs.last_hidden_state[:, 0, :].cpu().numpy()
+
+# Model of the CPU workers, inherited copy-on-write when they are forked
+workerModel = None
+
+def initWorker(threads, counter, cores, model=None):
 
-    # Create a data loader
-    data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+    global workerModel
+    if model is not None:
+        workerModel = model
 
-    # Compute the embeddings
-    ids = []
-    embeddings = []
+    # Fixed intra-op threads per worker, pinned to the worker's own cores when there are enough of them,
+    # an ONNX graph is passed by path and each worker opens its own session
+    torch.set_num_threads(threads)
+    if isinstance(workerModel, str):
+        workerModel = onnxSession(workerModel, threads)
+    with counter.get_lock():
+        workerIdx = counter.value
+        counter.value += 1
+    if len(cores) >= (workerIdx + 1) * threads:
+        os.sched_setaffinity(0, cores[workerIdx * threads:(workerIdx + 1) * threads])
 
+def embedWorker(batch):
     with torch.no_grad():
-        for batch in tqdm(data_loader, desc=f"{name} [Split {splitIdx}]"):
+        return embedBatch(workerModel, {k: torch.from_numpy(v) for k, v in batch.items()})
 
-            # Move batch to the same device as model
-            idBatch = deepcopy(batch['id'])
-            batch = {k: v.to(model.device) for k, v in batch.items() if k != 'id'}
+def startWorkers(model, workers, threads):
 
-            # Generate embeddings
-            outputs = model(**batch)
+    # Fork before any inference has run in this process, so the workers share the weights and start
+    # with a clean OpenMP state, frozen objects stay out of the workers' garbage collections
+    global workerModel
+    workerModel = model
+    fork = 'fork' in get_all_start_methods()
+    context = get_context('fork' if fork else None)
+    gc.freeze()
 
-            # Save the IDs
-            ids.extend(idBatch)
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    return context.Pool(processes=workers, initializer=initWorker, initargs=(threads, context.Value('i', 0), cores, None if fork else model))
 
-            # Move embeddings to CPU
-            embeddings.append(outputs.last_hidden_state[:, 0, :].cpu())
+def embedBatches(model, dataset, batches, collate, desc, pool=None):
+
+    # Create a data loader over the given index batches
+    data_loader = DataLoader(dataset, batch_sampler=batches, collate_fn=collate)
+
+    # Compute the embeddings, placed back at their dataset positions
+    embeddings = None
+
+    with torch.no_grad():
+
+        # Workers take batches from the pool's shared queue, results come back in batch order
+        if pool is not None:
+            results = pool.imap(embedWorker, ({k: v.numpy() for k, v in batch.items()} for batch in data_loader))
+        else:
+            results = (embedBatch(model, batch) for batch in data_loader)
+
+        for indices, cls in zip(batches, tqdm(results, total=len(batches), desc=desc)):
+            if embeddings is None:
+                embeddings = np.empty((len(dataset), cls.shape[1]), dtype=cls.dtype)
+            embeddings[indices] = cls
             torch.cuda.empty_cache()
 
-    # Concatenate all collected embeddings
-    embeddings = torch.cat(embeddings, dim=0)
-    embeddings = embeddings.numpy()
+    return embeddings if embeddings is not None else np.empty((0, 0), dtype=np.float32)
 
-    # Map the IDs to embeddings
-    embeddings = {id: emb for id, emb in zip(ids, embeddings)}
+def computeEmbeddings(name, splitIdx, model, dataset, collate, args, store=None, start=0, done=0, pool=None):
+
+    # Fill the split's rows of the input type's store one block at a time, so only a block is held in memory,
+    # and record each flushed block so an interrupted run resumes after it
+    if store is not None:
+        blocks = range(max(done - start, 0), len(dataset), args.block_size)
+        for blockIdx, blockStart in enumerate(blocks, 1):
+            block = dataset.select(range(blockStart, min(blockStart + args.block_size, len(dataset))))
+
+            # Batch similar lengths together, embeddings come back in block order
+            batches = lengthBatches(list(block['length']), args.max_tokens, args.batch_size)
+            store[start + blockStart:start + blockStart + len(block)] = embedBatches(model, block, batches, collate, f"{name} [Split {splitIdx}, Block {blockIdx}/{len(blocks)}]", pool)
+            store.flush()
+            saveProgress(args.save, name, start + blockStart + len(block), args.settings)
+
+        return True
 
     #-------
 
-    with open(f'{args.save}/{name}-emb{splitIdx}.pkl', 'wb') as f:
+    # Or map the IDs to embeddings and pickle the split, replacing the file only once it is complete
+    batches = lengthBatches(list(dataset['length']), args.max_tokens, args.batch_size)
+    embeddings = embedBatches(model, dataset, batches, collate, f"{name} [Split {splitIdx}]", pool)
+    embeddings = {id: emb for id, emb in zip(dataset['id'], embeddings)}
+
+    file = f'{args.save}/{name}-emb{splitIdx}.pkl'
+    with open(file + '.tmp', 'wb') as f:
         pickle.dump(embeddings, f)
+    os.replace(file + '.tmp', file)
 
     return True
 
+def benchmarkBatching(name, model, dataset, collate, args, pool=None):
+
+    # Fixed-size batches in dataset order against length-bucketed batches under the token budget
+    lengths = list(dataset['length'])
+    batchings = {
+        'dataset order': [list(range(i, min(i + args.batch_size, len(dataset)))) for i in range(0, len(dataset), args.batch_size)],
+        'length buckets': lengthBatches(lengths, args.max_tokens, args.batch_size)
+    }
+
+    results = {}
+    for method, batches in batchings.items():
+        start = time.perf_counter()
+        results[method] = embedBatches(model, dataset, batches, collate, f'{name} [{method}]', pool)
+        seconds = time.perf_counter() - start
+        tokens, attention = batchCost(lengths, batches)
+        print(f'{name} ({method}): {len(batches)} batches, {tokens:,} padded tokens ({sum(lengths) / tokens:.0%} real), attention cost {attention:,}, {len(dataset) / seconds:,.1f} papers/sec')
+
+    # Padding is masked, so the embeddings only differ by float noise
+    a, b = results['dataset order'], results['length buckets']
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    print(f'{name}: minimum cosine similarity between batchings {cosine.min():.6f}\n')
+
+def benchmarkWorkers(name, model, dataset, collate, args):
+
+    # Worker counts from 1 to all cores, each worker with an equal share of the cores
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    counts = sorted({min(2 ** k, cores) for k in range(cores.bit_length() + 1)})
+    batches = lengthBatches(list(dataset['length']), args.max_tokens, args.batch_size)
+
+    # Worker pools first, forked before this process runs any inference, a single in-process model last
+    results = {}
+    for workers in counts + [0]:
+        threads = max(cores // max(workers, 1), 1)
+        method = f'{workers} workers x {threads} threads' if workers else f'in-process x {cores} threads'
+
+        pool = startWorkers(model, workers, threads) if workers else None
+        if not workers:
+            torch.set_num_threads(cores)
+            if isinstance(model, str):
+                model = onnxSession(model, cores)
+
+        start = time.perf_counter()
+        results[method] = (embedBatches(model, dataset, batches, collate, f'{name} [{method}]', pool), time.perf_counter() - start)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # Speed up over one worker, embeddings only differ by float noise
+    reference, single = results[next(iter(results))]
+    for method, (embeddings, seconds) in results.items():
+        print(f'{name} ({method}): {len(dataset) / seconds:,.1f} papers/sec, {single / seconds:.2f}x, max difference {np.abs(embeddings - reference).max():.2e}')
+    print()
+
+def benchmarkBackends(name, backends, dataset, collate, args):
+
+    # Same batches through every backend, eager fp32 PyTorch first as the reference
+    batches = lengthBatches(list(dataset['length']), args.max_tokens, args.batch_size)
+
+    results = {}
+    for backend, model in backends.items():
+        start = time.perf_counter()
+        results[backend] = (embedBatches(model, dataset, batches, collate, f'{name} [{backend}]'), time.perf_counter() - start)
+
+    reference, single = results['torch']
+    for backend, (embeddings, seconds) in results.items():
+        cosine = (embeddings * reference).sum(axis=1) / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference, axis=1))
+        print(f'{name} ({backend}): {len(dataset) / seconds:,.1f} papers/sec, {single / seconds:.2f}x, cosine similarity to fp32 mean {cosine.mean():.6f} min {cosine.min():.6f}')
+    print()
+
 #-------
 
-def main(args):
+# Tokenize every field once and cache the token ids on disk, then assemble each input type from them
+def sharedTokens(dataset, tokenizer, prefix, args):
 
-    print('\nLoading the data...\n')
-    
-    # Load the data
-    dataset = load_from_disk(args.data + '/all')
+    fields = ['title', 'abstract', 'references', 'fos']
 
-    datasetByInputType = {
-        inputType: deepcopy(dataset.filter(lambda x: filterDataset(x, inputTypeList), desc=f'Filtering {inputType}')) for inputType, inputTypeList in args.input_types.items()
-    }
+    # Room left for [CLS] and [SEP], no field can contribute more than that to a sequence
+    limit = 512 - tokenizer.num_special_tokens_to_add()
 
-    pprint(datasetByInputType)
+    # One cache per dataset version and tokenizer
+    cache = f'{args.save}/tokens-{fileName(args.model)}-{dataset._fingerprint}'
 
-    del dataset
-    gc.collect()
+    if os.path.exists(cache):
+        tokens = load_from_disk(cache)
+    else:
+        def tokenizeFields(batch):
+            tokens = {'id': batch['id']}
+            for key in fields:
+                texts = [f'{prefix[key]} {item}.' for item in batch[key]] if key in prefix else batch[key]
+                tokens[key] = tokenizer(texts, add_special_tokens=False, truncation=True, max_length=limit, return_attention_mask=False)['input_ids']
+                tokens[f'{key}Available'] = [bool(item) for item in batch[key]]
+            return tokens
+
+        tokens = dataset.map(tokenizeFields, batched=True, batch_size=1000, remove_columns=dataset.column_names, desc='Tokenizing fields')
+
+        # Written next to the cache and moved into place, an interrupted save never looks like a finished cache
+        shutil.rmtree(cache + '.tmp', ignore_errors=True)
+        tokens.save_to_disk(cache + '.tmp')
+        os.replace(cache + '.tmp', cache)
+        tokens = load_from_disk(cache)
 
     #-------
 
-    print('\nApplying prefixes...\n')
+    # Fields joined by [SEP] and truncated as the tokenizer would truncate the joined text
+    def assemble(batch, inputType):
+        inputIds = []
+        for i in range(len(batch['id'])):
+            ids = list(batch[inputType[0]][i])
+            for key in inputType[1:]:
+                ids += [tokenizer.sep_token_id] + batch[key][i]
+            inputIds.append(tokenizer.build_inputs_with_special_tokens(ids[:limit]))
+
+        return {
+            'input_ids': inputIds,
+            'attention_mask': [[1] * len(ids) for ids in inputIds],
+            'length': [len(ids) for ids in inputIds]
+        }
+
+    available = {key: np.array(tokens[f'{key}Available']) for key in fields}
+
+    datasetByInputType = {}
+    for name, inputType in args.input_types.items():
+        indices = np.flatnonzero(np.logical_and.reduce([available[key] for key in inputType]))
+        datasetByInputType[name] = tokens.select(indices).map(
+            assemble, fn_kwargs={'inputType': inputType}, batched=True, batch_size=1000,
+            remove_columns=[column for column in tokens.column_names if column != 'id'], desc=f'Assembling {name}'
+        )
+
+    return datasetByInputType
+
+#-------
+
+def main(args):
+
+    print('\nLoading the data...\n')
+    
+    # Load the data
+    dataset = load_from_disk(args.data + '/all')
 
     # Set prefix
     prefix = {
@@ -127,18 +407,36 @@ def main(args):
         'fos': 'Fields of Study:'
     }
 
-    for inputType in args.input_types.keys():
-        for prefixKey in prefix.keys():
-            if prefixKey in args.input_types[inputType]:
-                datasetByInputType[inputType] = datasetByInputType[inputType].map(lambda x: {prefixKey: [f'{prefix[prefixKey]} {item}.' for item in x[prefixKey]]}, batched=True, batch_size=32, desc=f'Prefix for {prefixKey}')
-
-    #-------
-
     print('\nSetting the tokenizer...\n')
 
     # Load tokenizer
     tokenizer = AutoTokenizer.from_pretrained(args.model)
 
+    #-------
+
+    if args.shared_tokens:
+        datasetByInputType = sharedTokens(dataset, tokenizer, prefix, args)
+        pprint(datasetByInputType)
+
+    else:
+        datasetByInputType = {
+            inputType: deepcopy(dataset.filter(lambda x: filterDataset(x, inputTypeList), desc=f'Filtering {inputType}')) for inputType, inputTypeList in args.input_types.items()
+        }
+
+        pprint(datasetByInputType)
+
+        print('\nApplying prefixes...\n')
+
+        for inputType in args.input_types.keys():
+            for prefixKey in prefix.keys():
+                if prefixKey in args.input_types[inputType]:
+                    datasetByInputType[inputType] = datasetByInputType[inputType].map(lambda x: {prefixKey: [f'{prefix[prefixKey]} {item}.' for item in x[prefixKey]]}, batched=True, batch_size=32, desc=f'Prefix for {prefixKey}')
+
+    del dataset
+    gc.collect()
+
+    #-------
+
     def tokenize(batch, inputType):
         texts = []
         for i in range(len(batch['id'])):
@@ -149,14 +447,25 @@ def main(args):
             text = re.sub(r'\s+', ' ', text)
             texts.append(text)
         
-        return tokenizer(
+        # Padding is left to the collator, per length-bucketed batch
+        tokens = tokenizer(
             texts,
-            padding=True,
             truncation=True,
             return_token_type_ids=False,
-            max_length=512,
-            return_tensors="pt"
+            max_length=512
         )
+        tokens['length'] = [len(ids) for ids in tokens['input_ids']]
+        return tokens
+
+    # Input types are already tokenized in the shared mode
+    def tokenizeInput(dataset, inputType, desc):
+        if args.shared_tokens:
+            return dataset
+        dataset = dataset.map(tokenize, fn_kwargs={'inputType': inputType}, batched=True, batch_size=1000, desc=desc)
+        return dataset.remove_columns(['title', 'abstract', 'references', 'fos'])
+
+    def collate(rows):
+        return tokenizer.pad([{'input_ids': row['input_ids'], 'attention_mask': row['attention_mask']} for row in rows], return_tensors='pt')
 
     #-------
 
@@ -166,10 +475,51 @@ def main(args):
     model = AutoAdapterModel.from_pretrained(args.model)
     model.load_adapter(args.adapter, source="hf", set_active=True)
     model.eval()
-    model.to(device)
+    hiddenSize = model.config.hidden_size
+
+    # The int8 and ONNX Runtime backends run on the CPU, the ONNX graph is exported once per model and adapter
+    modelDevice = device if args.backend == 'torch' and not args.benchmark_backends else torch.device('cpu')
+    model.to(modelDevice)
+
+    onnxPath = f'{args.save}/{fileName(args.model)}-{fileName(args.adapter)}.onnx'
+    if args.benchmark_backends:
+        backends = {'torch': model, 'int8': quantizeModel(model)}
+        if onnxruntime is not None:
+            backends['onnx'] = exportOnnx(model, onnxPath)
+    elif args.backend == 'int8':
+        model = quantizeModel(model)
+    elif args.backend == 'onnx':
+        model = exportOnnx(model, onnxPath)
+
+    # CPU worker processes, started before anything runs through the model
+    pool = None
+    if modelDevice.type == 'cpu':
+        if args.threads_per_worker is None:
+            args.threads_per_worker = max((len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()) // args.workers, 1)
+        if args.workers > 1 and not (args.benchmark_workers or args.benchmark_backends):
+            pool = startWorkers(model, args.workers, args.threads_per_worker)
+        else:
+            torch.set_num_threads(args.threads_per_worker)
+            # benchmarkWorkers forks its pools from this process, it opens the session for its in-process run itself
+            if isinstance(model, str) and not args.benchmark_workers:
+                model = onnxSession(model, args.threads_per_worker)
+            if args.benchmark_backends and 'onnx' in backends:
+                backends['onnx'] = onnxSession(backends['onnx'], args.threads_per_worker)
 
     #-------
 
+    if args.benchmark or args.benchmark_workers or args.benchmark_backends:
+        for name, inputType in args.input_types.items():
+            dataset = datasetByInputType[name].select(range(min(args.benchmark or args.benchmark_workers or args.benchmark_backends, len(datasetByInputType[name]))))
+            datasetInput = tokenizeInput(dataset, inputType, f'Tokenizing {name}')
+            if args.benchmark_backends:
+                benchmarkBackends(name, backends, datasetInput, collate, args)
+            elif args.benchmark_workers:
+                benchmarkWorkers(name, model, datasetInput, collate, args)
+            else:
+                benchmarkBatching(name, model, datasetInput, collate, args, pool)
+        return True
+
     print('\nComputing the embeddings...\n')
 
     for name, inputType in args.input_types.items():
@@ -179,18 +529,32 @@ def main(args):
         # Find the split indices
         splits = splitIndices(len(dataset), args.splits)
 
+        # One matrix per input type, each split fills its rows
+        store, done = None, 0
+        if args.output_format == 'npy':
+            store, done = openStore(args.save, name, list(dataset['id']), hiddenSize, args.dtype, args.settings, args.resume)
+            if done:
+                print(f'{name}: resuming after {done:,} of {len(dataset):,} embeddings\n')
+
         for splitIdx in range(1, len(splits)):
+
+            # Skip splits that are already written
+            if splits[splitIdx] <= done or (store is None and args.resume and os.path.exists(f'{args.save}/{name}-emb{splitIdx}.pkl')):
+                continue
+
             datasetSplit = dataset.select(range(splits[splitIdx-1], splits[splitIdx]))
 
             # Apply the tokenizer to the dataset
-            datasetInput = datasetSplit.map(tokenize, fn_kwargs={'inputType': inputType}, batched=True, batch_size=args.batch_size, desc=f'Tokenizing {name} [Split {splitIdx}]')
-            datasetInput = datasetInput.remove_columns(['title', 'abstract', 'references', 'fos'])
-            datasetInput.set_format('pt', columns=['input_ids', 'attention_mask'], output_all_columns=True)
+            datasetInput = tokenizeInput(datasetSplit, inputType, f'Tokenizing {name} [Split {splitIdx}]')
             torch.cuda.empty_cache()
 
             # Compute the embeddings
-            computeEmbeddings(name, splitIdx, model, datasetInput, args)
+            computeEmbeddings(name, splitIdx, model, datasetInput, collate, args, store, splits[splitIdx-1], done, pool)
     
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     print(f'Embeddings saved in {args.save}.\n')
     return True
 
@@ -216,16 +580,32 @@ if __name__ == "__main__":
     parser.add_argument('--model', type=str, default='allenai/specter2_base')
     parser.add_argument('--adapter', type=str, default='allenai/specter2')
     parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--max-tokens', type=int, default=16 * 512, help='Padded tokens per batch, 0 for fixed --batch-size batches')
+    parser.add_argument('--output-format', type=str, default='npy', choices=['npy', 'pkl'], help='Memory-mappable store per input type, or a pickled dict per split')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'], help='Stored precision of the npy format')
+    parser.add_argument('--benchmark', type=int, default=0, help='Compare dataset-order and length-bucketed batches on N papers per input type and exit')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'int8', 'onnx'], help='Eager PyTorch, int8 dynamically quantized PyTorch on the CPU, or the exported graph in ONNX Runtime on the CPU')
+    parser.add_argument('--benchmark-backends', type=int, default=0, help='Compare the throughput and cosine similarity to fp32 of every backend on N papers per input type and exit')
+    parser.add_argument('--workers', type=int, default=1, help='CPU worker processes, each running batches on its own share of the cores')
+    parser.add_argument('--threads-per-worker', type=int, default=None, help='Intra-op threads of each CPU worker, defaults to the cores divided by --workers')
+    parser.add_argument('--benchmark-workers', type=int, default=0, help='Compare 1 to all-core CPU workers on N papers per input type and exit')
     parser.add_argument('--splits', type=int, default=10)
+    parser.add_argument('--shared-tokens', action='store_true', help='Tokenize each field once, cached in the embeddings folder, and assemble the input types from it')
+    parser.add_argument('--block-size', type=int, default=10000, help='Embeddings computed and flushed to the npy store at a time')
+    parser.add_argument('--resume', action='store_true', help='Continue after the last completed block (npy) or split (pkl) of a previous run')
     parser.add_argument('--input-types', type=str, required=True, choices=['all'] + list(inputTypes.keys()), nargs='+')
 
     args = parser.parse_args()
 
     args.data = args.data.rstrip('/')
+    args.settings = {'model': args.model, 'adapter': args.adapter, 'backend': args.backend, 'shared_tokens': args.shared_tokens}
     args.save = f"./data/embeddings/{os.path.basename(args.data)}"
     if not os.path.exists(args.save):
         os.mkdir(args.save)
 
+    if args.backend == 'onnx' and onnxruntime is None:
+        parser.error('--backend onnx needs onnxruntime')
+
     if 'all' in args.input_types:
         args.input_types = inputTypes
     else: